@@ -34,6 +34,9 @@ setup(
     entry_points = {
         'trac.plugins': [
             'tracexceldownload.api = tracexceldownload.api',
+            'tracexceldownload.cache = tracexceldownload.cache',
+            'tracexceldownload.delta = tracexceldownload.delta',
+            'tracexceldownload.jobs = tracexceldownload.jobs',
             'tracexceldownload.ticket = tracexceldownload.ticket',
             'tracexceldownload.translation = tracexceldownload.translation',
         ],
@@ -1,52 +1,112 @@
 # -*- coding: utf-8 -*-
 
+import cPickle
+import gzip
 import inspect
+import os
 import re
+import select
+import socket
+import struct
 import sys
+import time
+import zipfile
+import zlib
+from array import array
 from cStringIO import StringIO
 from datetime import datetime
 from decimal import Decimal
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import chain, izip
+from tempfile import SpooledTemporaryFile, TemporaryFile
+from pkgutil import find_loader
 from unicodedata import east_asian_width
-try:
-    import openpyxl
-except ImportError:
-    openpyxl = None
-try:
-    import xlwt
-except ImportError:
-    xlwt = None
 
 from trac.core import Component, TracError
 from trac.util.text import to_unicode
-from tracexceldownload.translation import ChoiceOption, N_, ngettext
+from trac.web.api import RequestDone
+from tracexceldownload.translation import (BoolOption, ChoiceOption,
+                                           FloatOption, IntOption, N_, _,
+                                           ngettext)
 
 
-__all__ = ('get_excel_format', 'get_excel_mimetype', 'get_workbook_writer')
+__all__ = ('encode_content', 'encode_converted', 'get_excel_format',
+           'get_excel_mimetype', 'get_workbook_writer',
+           'get_permission_fingerprint', 'get_work_dir', 'send_file_header',
+           'Hyperlink')
 
 
 def get_literal(text):
     return u'"%s"' % to_unicode(text).replace('"', '""')
 
 
-def get_excel_format(env):
+class Hyperlink(object):
+    """Cell value linking to `url` with `label` as the displayed text.
+
+    The workbook writers render it in the cheapest form of their format
+    rather than parsing a `HYPERLINK()` formula for each cell.
+    """
+
+    __slots__ = ('url', 'label')
+
+    def __init__(self, url, label):
+        self.url = to_unicode(url)
+        self.label = to_unicode(label)
+
+    def __repr__(self):
+        return '<%s %r %r>' % (self.__class__.__name__, self.url, self.label)
+
+    def formula(self):
+        return u'HYPERLINK(%s,%s)' % (get_literal(self.url),
+                                      get_literal(self.label))
+
+
+_available_modules = {}
+
+
+def _has_module(name):
+    """Return whether the top-level module `name` is available, without
+    importing it. The backends are imported on the first export.
+    """
+    available = _available_modules.get(name)
+    if available is None:
+        if name in sys.modules:
+            available = sys.modules[name] is not None
+        else:
+            try:
+                available = find_loader(name) is not None
+            except ImportError:
+                available = False
+        _available_modules[name] = available
+    return available
+
+
+def _get_writer_class(env):
     format = ExcelDownloadConfig(env).format
     if format == '(auto)':
-        if openpyxl:
-            return 'xlsx'
-        if xlwt:
-            return 'xls'
-        raise TracError("Require openpyxl or xlwt library")
+        if _has_module('openpyxl'):
+            return OpenpyxlWorkbookWriter
+        if _has_module('xlwt'):
+            return XlwtWorkbookWriter
+        return SpreadsheetMLWorkbookWriter
     if format == 'xlsx':
-        if openpyxl:
-            return format
+        if _has_module('openpyxl'):
+            return OpenpyxlWorkbookWriter
         raise TracError("Require openpyxl library")
     if format == 'xls':
-        if xlwt:
-            return format
+        if _has_module('xlwt'):
+            return XlwtWorkbookWriter
         raise TracError("Require xlwt library")
+    if format == 'xlsx-native':
+        return SpreadsheetMLWorkbookWriter
     raise TracError("Unsupported format: '%s'" % format)
 
 
+def get_excel_format(env):
+    return _get_writer_class(env).ext
+
+
 def _writer(ext):
     for cls in (OpenpyxlWorkbookWriter, XlwtWorkbookWriter):
         if cls.ext == ext:
@@ -59,11 +119,205 @@ def get_excel_mimetype(ext):
 
 
 def get_workbook_writer(env, req):
-    ext = get_excel_format(env)
-    cls = _writer(ext)
+    cls = _get_writer_class(env)
     return cls(env, req)
 
 
+def get_work_dir(env, name):
+    """Return the directory `name` for working files of this plugin in the
+    environment, creating it if missing.
+    """
+    path = os.path.join(env.path, 'files', 'exceldownload', name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+# permission policies which never decide on a specific ticket
+_coarse_permission_policies = frozenset(['DefaultPermissionPolicy',
+                                         'DefaultWikiPolicy',
+                                         'LegacyAttachmentPolicy',
+                                         'ReadonlyWikiPolicy'])
+
+
+def has_fine_grained_policies(env):
+    from trac.perm import PermissionSystem
+    return any(policy.__class__.__name__ not in _coarse_permission_policies
+               for policy in PermissionSystem(env).policies)
+
+
+def get_permission_fingerprint(env, req):
+    """Return a string which is identical for users who are granted the same
+    permissions. It includes the username when a fine-grained permission
+    policy is active.
+    """
+    from trac.perm import PermissionSystem
+    perms = PermissionSystem(env).get_user_permissions(req.authname)
+    actions = sorted(action for action, granted in perms.iteritems()
+                            if granted)
+    if has_fine_grained_policies(env):
+        actions.insert(0, 'user:' + req.authname)
+    return ','.join(actions)
+
+
+def _accepts_gzip(req):
+    accept = req.get_header('Accept-Encoding') or ''
+    for item in accept.split(','):
+        name, params = (item.split(';', 1) + [''])[:2]
+        if name.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def encode_content(env, req, mimetype, content):
+    """Compress `content`, a tuple of the size and a chunk iterator, with
+    gzip for the response to `req` when `[exceldownload] xls_gzip` applies
+    and send the `Content-Encoding` header. Return a tuple of the size and
+    a chunk iterator of the content to send. The size is `None` when it
+    isn't known in advance.
+
+    The whole content is compressed into a spooled temporary file before
+    the first chunk is returned, as the compressed size must be known.
+    """
+    config = ExcelDownloadConfig(env)
+    if not config.xls_gzip or mimetype != XlwtWorkbookWriter.mimetype:
+        return content
+    req.send_header('Vary', 'Accept-Encoding')
+    size, chunks = content
+    if size < config.gzip_min_size or not _accepts_gzip(req):
+        return content
+    out = SpooledTemporaryFile(max_size=config.spool_size)
+    try:
+        f = gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=0)
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+        finally:
+            f.close()
+        size = out.tell()
+        out.seek(0)
+    except:
+        out.close()
+        raise
+    req.send_header('Content-Encoding', 'gzip')
+    return size, _iter_file(out)
+
+
+def send_file_header(req, name, value):
+    """Send the header `name` of the response which carries the exported
+    file. A background export keeps the header with its job until the file
+    is downloaded.
+    """
+    file_headers = getattr(req, 'file_headers', None)
+    if file_headers is not None:
+        file_headers.append((name, value))
+    else:
+        req.send_header(name, value)
+
+
+def encode_converted(env, req):
+    """Compress the xls file which `Mimeview.send_converted` sends in the
+    response to `req` like `encode_content`. The headers of the response
+    are deferred until its content is written, as the compressed size
+    must be known.
+    """
+    config = ExcelDownloadConfig(env)
+    if config.xls_gzip and get_excel_format(env) == 'xls':
+        _EncodedResponse(env, req)
+
+
+class _EncodedResponse(object):
+    """Intercept the headers and the content of the response to `req`."""
+
+    def __init__(self, env, req):
+        self.env = env
+        self.req = req
+        self.headers = []
+        self._methods = req.send_header, req.end_headers, req.write
+        req.send_header = self.send_header
+        req.end_headers = self.end_headers
+        req.write = self.write
+
+    def send_header(self, name, value):
+        self.headers.append((name, value))
+
+    def end_headers(self):
+        if self._get_header('Content-Type') != XlwtWorkbookWriter.mimetype:
+            self._restore()  # e.g. a redirect to a background export
+            self._send_headers()
+            self.req.end_headers()
+
+    def write(self, data):
+        self._restore()
+        req = self.req
+        if isinstance(data, str):
+            size = len(data)
+            data = (data,)
+        else:
+            size = self._get_header('Content-Length')
+        if size is None:  # sent with chunked encoding
+            out = SpooledTemporaryFile(
+                max_size=ExcelDownloadConfig(self.env).spool_size)
+            for chunk in data:
+                out.write(chunk)
+            size = out.tell()
+            out.seek(0)
+            data = _iter_file(out)
+        size, chunks = encode_content(self.env, req,
+                                      XlwtWorkbookWriter.mimetype,
+                                      (int(size), iter(data)))
+        self._send_headers(exclude='content-length')
+        req.send_header('Content-Length', size)
+        req.end_headers()
+        req.write(chunks)
+
+    def _get_header(self, name):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+
+    def _send_headers(self, exclude=None):
+        for name, value in self.headers:
+            if name.lower() != exclude:
+                self.req.send_header(name, value)
+
+    def _restore(self):
+        req = self.req
+        req.send_header, req.end_headers, req.write = self._methods
+
+
+def _iter_file(f, chunk_size=65536):
+    """Yield the content of file object `f` in chunks and close it."""
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+def _get_datetime_width(style):
+    if style == '[date]':
+        return len('YYYY-MM-DD')
+    if style == '[time]':
+        return len('HH:MM:SS')
+    return len('YYYY-MM-DD HH:MM:SS')
+
+
 def _max_rows_error(num):
     message = ngettext(
         "Number of rows in the Excel sheet exceeded the limit of %(num)d row",
@@ -90,10 +344,342 @@ def _make_invalid_chars_re():
     return re.compile(pattern)
 
 
+def _make_dirty_text_re(invalid_chars_re):
+    # matches text which `_normalize_text` changes: invalid characters,
+    # line breaks other than LF, trailing spaces of lines and trailing LF
+    pattern = u'|'.join((invalid_chars_re.pattern,
+                         u'[\r\x1c-\x1e\x85\u2028\u2029]',
+                         u'[^\\S\n](?=\n|\\Z)', u'\n\\Z'))
+    return re.compile(pattern, re.UNICODE)
+
+
+class _TextMetrics(object):
+    """Compute the display width and the number of lines of text.
+
+    Widths are looked up in a table of the BMP for each `ambiwidth`, pure
+    ASCII text is measured by its length, and a line is measured no further
+    than `max_width` which is the widest column `set_col_widths` creates.
+    The metrics of short values are cached in a dict which is cleared
+    when it is full, so that a hit costs a single lookup.
+    """
+
+    max_width = 50
+    cache_size = 16384
+    cache_value_len = 64
+
+    _tables = {}
+
+    def __init__(self, ambiwidth):
+        self._doubles = ('WFA', 'WF')[ambiwidth == 1]
+        self._table = self._get_table(ambiwidth)
+        self._cache = {}
+
+    def __call__(self, value):
+        if not value:
+            return 0, 1
+        if isinstance(value, str):
+            value = to_unicode(value)
+        cache = self._cache
+        metrics = cache.get(value)
+        if metrics is None:
+            metrics = self._measure(value)
+            if len(value) <= self.cache_value_len:
+                if len(cache) >= self.cache_size:
+                    cache.clear()
+                cache[value] = metrics
+        return metrics
+
+    def _measure(self, value):
+        max_width = self.max_width
+        lines = value.splitlines()
+        try:
+            value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+        else:
+            return min(max(len(line) for line in lines), max_width), \
+                   len(lines)
+        table = self._table
+        doubles = self._doubles
+        width = 0
+        for line in lines:
+            # every character is at least 1 column wide
+            if len(line) >= max_width:
+                return max_width, len(lines)
+            line_width = 0
+            for ch in line:
+                code = ord(ch)
+                if code < 0x10000:
+                    line_width += table[code]
+                else:
+                    line_width += (1, 2)[east_asian_width(ch) in doubles]
+            if width < line_width:
+                width = min(line_width, max_width)
+        return width, len(lines)
+
+    @classmethod
+    def _get_table(cls, ambiwidth):
+        table = cls._tables.get(ambiwidth)
+        if table is None:
+            doubles = ('WFA', 'WF')[ambiwidth == 1]
+            table = bytearray((1, 2)[east_asian_width(unichr(code)) in doubles]
+                              for code in xrange(0x10000))
+            cls._tables[ambiwidth] = table
+        return table
+
+
 class ExcelDownloadConfig(Component):
 
-    format = ChoiceOption('exceldownload', 'format', ('(auto)', 'xlsx', 'xls'),
-        doc=N_("Specifies the format of Excel file to download."))
+    format = ChoiceOption('exceldownload', 'format',
+                          ('(auto)', 'xlsx', 'xls', 'xlsx-native'),
+        doc=N_("Specifies the format of Excel file to download. "
+               "`xlsx-native` writes xlsx files without openpyxl."))
+
+    spool_size = IntOption('exceldownload', 'spool_size', 1048576,
+        doc=N_("Maximum size in bytes of a generated Excel file which is "
+               "kept in memory. Larger files are spooled to a temporary "
+               "file. The file is complete before it is sent to the "
+               "client in chunks read from memory or the temporary file, "
+               "except for an `xlsx-native` workbook which is sent while "
+               "it is written."))
+
+    xlsx_row_buffer_size = IntOption(
+        'exceldownload', 'xlsx_row_buffer_size', 16777216,
+        doc=N_("Maximum estimated size in bytes of the rows of an xlsx "
+               "sheet which the openpyxl backend buffers in memory until "
+               "the column widths are known. Larger buffers are written to "
+               "a temporary file in the environment and read back when the "
+               "sheet is finished. When 0, the rows are kept in memory."))
+
+    col_width_sample_rows = IntOption(
+        'exceldownload', 'col_width_sample_rows', 0,
+        doc=N_("Number of leading rows used to estimate column widths of "
+               "xlsx sheets. Later rows are written straight to the sheet "
+               "stream instead of being buffered. When 0, all rows are "
+               "buffered and the column widths are exact."))
+
+    cache_size = IntOption('exceldownload', 'cache_size', 0,
+        doc=N_("Maximum total size in bytes of generated Excel files which "
+               "are cached in the environment and served again for the same "
+               "query or report. When 0, the cache is disabled."))
+
+    cache_max_age = IntOption('exceldownload', 'cache_max_age', 86400,
+        doc=N_("Number of seconds after which a cached Excel file is "
+               "evicted."))
+
+    background_workers = IntOption('exceldownload', 'background_workers', 0,
+        doc=N_("Number of threads which generate Excel files in the "
+               "background when `background=1` is passed with an export "
+               "request. The client is redirected to a page which polls for "
+               "the result. When 0, background exports are disabled."))
+
+    background_queue_size = IntOption(
+        'exceldownload', 'background_queue_size', 16,
+        doc=N_("Maximum number of background exports waiting for a "
+               "thread."))
+
+    delta_token_max_age = IntOption(
+        'exceldownload', 'delta_token_max_age', 604800,
+        doc=N_("Number of seconds after which a token of a delta export "
+               "expires. A query export with `since=` returns a token in "
+               "the `X-Excel-Delta-Token` header and on the marker sheet, "
+               "and the next export with `since=<token>` only contains the "
+               "tickets changed since then."))
+
+    xlsx_compression_level = IntOption(
+        'exceldownload', 'xlsx_compression_level', -1,
+        doc=N_("Deflate level from 1 (fastest) to 9 (smallest) of xlsx "
+               "files, or 0 to store the parts without compression. When "
+               "-1, the default level of zlib is used. The openpyxl backend "
+               "only supports 0 and the default level."))
+
+    xls_gzip = BoolOption('exceldownload', 'xls_gzip', 'false',
+        doc=N_("Compress xls files with gzip `Content-Encoding` when the "
+               "client accepts it. xlsx files are already compressed."))
+
+    gzip_min_size = IntOption('exceldownload', 'gzip_min_size', 65536,
+        doc=N_("Minimum size in bytes of an xls file to be compressed with "
+               "gzip when `xls_gzip` is enabled."))
+
+    sheet_threads = IntOption('exceldownload', 'sheet_threads', 0,
+        doc=N_("Number of threads which compress the worksheets of an "
+               "`xlsx-native` workbook with several sheets in parallel. "
+               "The rows of the sheets are still written one sheet after "
+               "another, only the compression of the finished sheets runs "
+               "in the threads. Workbooks smaller than 1 MB and, when 0 or "
+               "1, all workbooks are compressed one sheet after another. "
+               "The other formats are not affected."))
+
+    timing_log_threshold = FloatOption(
+        'exceldownload', 'timing_log_threshold', 10.0,
+        doc=N_("Number of seconds an export must take for the timings of "
+               "its phases to be logged at info level. Timings of faster "
+               "exports are logged at debug level. When negative, timings "
+               "are only logged at debug level."))
+
+    export_time_budget = FloatOption(
+        'exceldownload', 'export_time_budget', 0,
+        doc=N_("Maximum number of seconds an export may take before it is "
+               "aborted with an error. The time is checked every few "
+               "hundred rows and before the file is written. Background "
+               "exports are not limited. When 0, exports are not "
+               "limited."))
+
+    timing_header = BoolOption('exceldownload', 'timing_header', 'false',
+        doc=N_("Send the timings of the phases of an export in a "
+               "`Server-Timing` response header to users with "
+               "`TRAC_ADMIN`."))
+
+
+def _get_disconnect_check(req):
+    """Return a function which tells whether the client of `req` has
+    disconnected, or `None` if the WSGI server doesn't expose the
+    connection.
+    """
+    environ = getattr(req, 'environ', None) or {}
+    sock = environ.get('gunicorn.socket')
+    if sock is not None:
+        def is_disconnected():
+            try:
+                if not select.select([sock], [], [], 0)[0]:
+                    return False
+                # readable without data when the peer closed the connection
+                return not sock.recv(1, socket.MSG_PEEK)
+            except (select.error, socket.error):
+                return True
+        return is_disconnected
+    if 'uwsgi.version' in environ:
+        try:
+            import uwsgi
+        except ImportError:
+            return None
+        return lambda: not uwsgi.is_connected(uwsgi.connection_fd())
+    return None
+
+
+class ExportAborted(TracError):
+    """The export exceeded its time budget."""
+
+
+class ExportCanceller(object):
+    """Abort the foreground export for `req` once the `export_time_budget`
+    is exceeded or the client has disconnected. Background exports are
+    never aborted.
+    """
+
+    checkpoint_rows = 256
+
+    def __init__(self, env, req):
+        self.env = env
+        self._countdown = self.checkpoint_rows
+        self._deadline = None
+        self._is_disconnected = None
+        if not req.environ.get('tracexceldownload.background'):
+            self._budget = ExcelDownloadConfig(env).export_time_budget
+            if self._budget > 0:
+                self._deadline = time.time() + self._budget
+            self._is_disconnected = _get_disconnect_check(req)
+
+    def checkpoint(self):
+        """Call `check` once every `checkpoint_rows` calls, for the rows of
+        an export.
+        """
+        self._countdown -= 1
+        if self._countdown <= 0:
+            self._countdown = self.checkpoint_rows
+            self.check()
+
+    def check(self):
+        """Raise `ExportAborted` if the time budget is exceeded, or
+        `RequestDone` if the client has disconnected.
+        """
+        deadline = self._deadline
+        if deadline is not None and time.time() > deadline:
+            self.env.log.info("Excel export aborted after exceeding the "
+                              "time budget of %s seconds", self._budget)
+            raise ExportAborted(_("The Excel export was aborted because it "
+                                  "took longer than %(seconds)s seconds. "
+                                  "Please narrow the query or report.",
+                                  seconds=self._budget))
+        is_disconnected = self._is_disconnected
+        if is_disconnected is not None and is_disconnected():
+            self.env.log.info("Excel export aborted after the client "
+                              "disconnected")
+            raise RequestDone
+
+
+class ExportTimings(object):
+    """Record the wall and CPU time and the numbers of rows and cells of
+    the phases of an export.
+
+    Coarse phases use the `phase` context manager. The loops over the rows
+    of a sheet call `start` and `stop` once around the whole loop, keeping
+    the clocks out of the code run for each row.
+    """
+
+    def __init__(self, env, name):
+        self.env = env
+        self.name = name
+        self.phases = OrderedDict()  # name -> [wall, cpu, rows, cells]
+        self._started = self.start()
+
+    def start(self):
+        return time.time(), time.clock()
+
+    def stop(self, name, started, rows=0, cells=0):
+        """Add the time since `started` to the phase `name` and return the
+        current time which can be used to start the next phase.
+        """
+        now = time.time(), time.clock()
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0.0, 0.0, 0, 0]
+        phase[0] += now[0] - started[0]
+        phase[1] += now[1] - started[1]
+        phase[2] += rows
+        phase[3] += cells
+        return now
+
+    @contextmanager
+    def phase(self, name, rows=0, cells=0):
+        started = self.start()
+        try:
+            yield
+        finally:
+            self.stop(name, started, rows, cells)
+
+    @property
+    def total(self):
+        wall, cpu = self._started
+        return time.time() - wall, time.clock() - cpu
+
+    def summary(self):
+        """Return the timings as a line for the log."""
+        wall, cpu = self.total
+        items = ['%s total %.3fs (cpu %.3fs)' % (self.name, wall, cpu)]
+        for name, (wall, cpu, rows, cells) in self.phases.iteritems():
+            item = '%s %.3fs (cpu %.3fs)' % (name, wall, cpu)
+            if rows or cells:
+                item += ' %d rows %d cells' % (rows, cells)
+            items.append(item)
+        return ', '.join(items)
+
+    def report(self, req):
+        """Log the timings and send them in a `Server-Timing` header if
+        enabled.
+        """
+        config = ExcelDownloadConfig(self.env)
+        threshold = config.timing_log_threshold
+        wall = self.total[0]
+        if 0 <= threshold <= wall:
+            self.env.log.info("Excel export timings: %s", self.summary())
+        else:
+            self.env.log.debug("Excel export timings: %s", self.summary())
+        if config.timing_header and 'TRAC_ADMIN' in req.perm:
+            items = ['%s;dur=%.1f' % (name, phase[0] * 1000)
+                     for name, phase in self.phases.iteritems()]
+            items.append('total;dur=%.1f' % (wall * 1000))
+            send_file_header(req, 'Server-Timing', ', '.join(items))
 
 
 class WorksheetWriterError(TracError): pass
@@ -115,7 +701,8 @@ class AbstractWorkbookWriter(object):
             self.ambiwidth = 1
         self.book = book
         self.styles = self._get_excel_styles()
-        self._metrics_cache = {}
+        self._metrics = _TextMetrics(self.ambiwidth)
+        self._normalized_texts = {}
 
     def create_sheet(self, title):
         raise NotImplemented
@@ -128,24 +715,43 @@ class AbstractWorkbookWriter(object):
         self.dump(out)
         return out.getvalue()
 
+    def iterdump(self, chunk_size=65536):
+        """Serialize the workbook into a spooled temporary file and return
+        a tuple of the size and an iterator which yields the content in
+        chunks.
+
+        The whole workbook is serialized before this returns. The chunks
+        only avoid holding the file in memory as a single string.
+        """
+        out = SpooledTemporaryFile(
+            max_size=ExcelDownloadConfig(self.env).spool_size)
+        try:
+            self.dump(out)
+            out.seek(0, 2)
+            size = out.tell()
+            out.seek(0)
+        except:
+            out.close()
+            raise
+        return size, _iter_file(out, chunk_size)
+
     def _get_excel_styles(self):
         raise NotImplemented
 
+    def resolve_style(self, name):
+        """Return the style for `name` in the form the worksheet writers of
+        this workbook use it. The result can be passed in the cells of
+        `write_row()` instead of the name to skip the lookup of the style.
+        """
+        if name not in self.styles:
+            if name.endswith(':change'):
+                name = '*:change'
+            else:
+                name = '*'
+        return name
+
     def get_metrics(self, value):
-        if not value:
-            return 0, 1
-        if isinstance(value, str):
-            value = to_unicode(value)
-        if value not in self._metrics_cache:
-            lines = value.splitlines()
-            doubles = ('WFA', 'WF')[self.ambiwidth == 1]
-            width = max(sum((1, 2)[east_asian_width(ch) in doubles]
-                            for ch in line)
-                        for line in lines)
-            if len(value) > 64:
-                return width, len(lines)
-            self._metrics_cache[value] = (width, len(lines))
-        return self._metrics_cache[value]
+        return self._metrics(value)
 
 
 class AbstractWorksheetWriter(object):
@@ -180,18 +786,32 @@ class AbstractWorksheetWriter(object):
         if widths[idx] < width:
             widths[idx] = width
 
+    def set_col_width_hints(self, hints):
+        pass
+
     def set_col_widths(self):
         raise NotImplemented
 
     _invalid_chars_re = _make_invalid_chars_re()
+    _dirty_text_re = _make_dirty_text_re(_invalid_chars_re)
+    _normalized_texts_size = 4096
+    _normalized_text_len = 64
 
     def _normalize_text(self, value):
+        memo = self.writer._normalized_texts
+        key = value
+        short = len(value) <= self._normalized_text_len
+        if short and key in memo:
+            return memo[key]
         if isinstance(value, str):
             value = to_unicode(value)
-        value = self._invalid_chars_re.sub(u'\ufffd', value)
-        value = '\n'.join(line.rstrip() for line in value.splitlines())
+        if self._dirty_text_re.search(value):
+            value = self._invalid_chars_re.sub(u'\ufffd', value)
+            value = '\n'.join(line.rstrip() for line in value.splitlines())
         if len(value) > self.MAX_CHARS:
             value = value[:self.MAX_CHARS - 1] + u'\u2026'
+        if short and len(memo) < self._normalized_texts_size:
+            memo[key] = value
         return value
 
 
@@ -202,9 +822,14 @@ class OpenpyxlWorkbookWriter(AbstractWorkbookWriter):
                'vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
     def __init__(self, env, req):
-        if not openpyxl:
+        try:
+            import openpyxl
+        except ImportError:
             raise TracError('Require openpyxl library')
-        book = self._create_book()
+        if 'write_only' in inspect.getargspec(openpyxl.Workbook.__init__)[0]:
+            book = openpyxl.Workbook(write_only=True)
+        else:
+            book = openpyxl.Workbook(optimized_write=True)
         AbstractWorkbookWriter.__init__(self, env, req, book)
         for style in self.styles.itervalues():
             book.add_named_style(style)
@@ -214,7 +839,13 @@ class OpenpyxlWorkbookWriter(AbstractWorkbookWriter):
         return OpenpyxlWorksheetWriter(sheet, self)
 
     def dump(self, out):
-        self.book.save(out)
+        if ExcelDownloadConfig(self.env).xlsx_compression_level == 0:
+            from openpyxl.writer.excel import ExcelWriter
+            archive = zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED,
+                                      allowZip64=True)
+            ExcelWriter(self.book, archive).save(out)
+        else:
+            self.book.save(out)
 
     def _get_excel_styles(self):
         from openpyxl.styles import (
@@ -296,16 +927,6 @@ class OpenpyxlWorkbookWriter(AbstractWorkbookWriter):
             styles.append(style_change(fn))
         return dict((style.name, style) for style in styles)
 
-    if not openpyxl:
-        def _create_book(self):
-            raise NotImplemented
-    elif 'write_only' in inspect.getargspec(openpyxl.Workbook.__init__)[0]:
-        def _create_book(self):
-            return openpyxl.Workbook(write_only=True)
-    else:
-        def _create_book(self):
-            return openpyxl.Workbook(optimized_write=True)
-
 
 class OpenpyxlWorksheetWriter(AbstractWorksheetWriter):
 
@@ -315,26 +936,31 @@ class OpenpyxlWorksheetWriter(AbstractWorksheetWriter):
 
     def __init__(self, sheet, writer):
         AbstractWorksheetWriter.__init__(self, sheet, writer)
-        self._rows = []
+        config = ExcelDownloadConfig(writer.env)
+        self._rows = _RowBuffer(writer.env, config.xlsx_row_buffer_size)
+        self._sample_rows = config.col_width_sample_rows
+        self._col_width_hints = {}
+        self._streaming = False
+
+    def set_col_width_hints(self, hints):
+        self._col_width_hints.update(hints)
 
     def write_row(self, cells):
         get_metrics = self.get_metrics
         tz = self.tz
         has_tz_normalize = hasattr(tz, 'normalize')  # pytz
+        streaming = self._streaming
 
         values = []
+        styles = []
         for idx, (value, style, width, line) in enumerate(cells):
             if isinstance(value, datetime):
                 value = value.astimezone(tz)
                 if has_tz_normalize:
                     value = tz.normalize(value)
                 value = datetime(*(value.timetuple()[0:6]))
-                if style == '[date]':
-                    width = len('YYYY-MM-DD')
-                elif style == '[time]':
-                    width = len('HH:MM:SS')
-                else:
-                    width = len('YYYY-MM-DD HH:MM:SS')
+                if width is None:
+                    width = _get_datetime_width(style)
                 width /= 1.2
                 line = 1
             elif isinstance(value, (int, long, float, Decimal)):
@@ -345,60 +971,187 @@ class OpenpyxlWorksheetWriter(AbstractWorksheetWriter):
                 line = 1
             elif isinstance(value, basestring):
                 value = self._normalize_text(value)
-
-            if width is None or line is None:
-                metrics = get_metrics(value)
+            elif isinstance(value, Hyperlink):
                 if width is None:
-                    width = metrics[0]
-                if line is None:
-                    line = metrics[1]
+                    width = get_metrics(value.label)[0]
+                line = 1
+
+            if not streaming:
+                if width is None or line is None:
+                    metrics = get_metrics(value)
+                    if width is None:
+                        width = metrics[0]
+                    if line is None:
+                        line = metrics[1]
+                self._set_col_width(idx, width)
 
-            cell = OpenpyxlCell(value)
             if style not in self.styles:
-                if style.endswith(':change'):
-                    style = '*:change'
-                else:
-                    style = '*'
-            cell.style = style
-            values.append(cell)
-            self._set_col_width(idx, width)
+                style = self.writer.resolve_style(style)
+            values.append(value)
+            styles.append(style)
 
-        self._rows.append(values or (None,))
+        if streaming:
+            self._append_row(values, styles)
+        else:
+            self._rows.append(values, styles)
+            if self._sample_rows > 0 and \
+                    len(self._rows) >= self._sample_rows:
+                self._flush_rows()
         self.row_idx += 1
 
     def set_col_widths(self):
+        if not self._streaming:
+            self._flush_rows()
+
+    def _flush_rows(self):
         from openpyxl.utils.cell import get_column_letter
-        from openpyxl.cell import Cell
-        TYPE_STRING = Cell.TYPE_STRING
 
-        for idx, width in sorted(self._col_widths.iteritems()):
+        widths = self._col_widths
+        if self._sample_rows > 0:
+            for idx, width in self._col_width_hints.iteritems():
+                self._set_col_width(idx, width)
+        for idx, width in sorted(widths.iteritems()):
             letter = get_column_letter(idx + 1)
             self.sheet.column_dimensions[letter].width = 1 + min(width, 50)
-        for row in self._rows:
-            values = []
-            for val in row:
-                if val:
-                    value = val.value
-                    cell = Cell(self.sheet, column='A', row=1)
-                    if isinstance(value, basestring):
-                        cell.set_explicit_value(value, data_type=TYPE_STRING)
-                    else:
-                        cell.value = value
-                    cell.style = val.style
-                else:
-                    cell = val
-                values.append(cell)
-            self.sheet.append(values)
-        self._rows[:] = ()
+        for values, styles in self._rows:
+            self._append_row(values, styles)
+        self._rows.close()
+        # column widths cannot be changed after the first row is written
+        self._streaming = True
 
+    def _append_row(self, values, styles):
+        from openpyxl.cell import Cell
+        TYPE_STRING = Cell.TYPE_STRING
+        TYPE_FORMULA = Cell.TYPE_FORMULA
+
+        if not values:
+            self.sheet.append((None,))
+            return
+        cells = []
+        for value, style in izip(values, styles):
+            cell = Cell(self.sheet, column='A', row=1)
+            if isinstance(value, basestring):
+                cell.set_explicit_value(value, data_type=TYPE_STRING)
+            elif isinstance(value, Hyperlink):
+                cell.set_explicit_value(u'=' + value.formula(),
+                                        data_type=TYPE_FORMULA)
+            else:
+                cell.value = value
+            cell.style = style
+            cells.append(cell)
+        self.sheet.append(cells)
 
-class OpenpyxlCell(object):
 
-    __slots__ = ('value', 'style')
+class _RowBuffer(object):
+    """Rows of a worksheet buffered until its column widths are known.
 
-    def __init__(self, value, style='*'):
-        self.value = value
-        self.style = style
+    The rows are stored by column: a list of the values and an
+    `array('B')` of the style ids of each column, with the number of
+    cells of each row. When the estimated size of the rows exceeds
+    `max_size` bytes, they are pickled as a block to a temporary file in
+    the environment, and `__iter__()` reads the blocks back in order.
+    When `max_size` is 0, the rows are kept in memory.
+    """
+
+    def __init__(self, env, max_size):
+        self.env = env
+        self.max_size = max_size
+        self._count = 0
+        self._style_ids = {}
+        self._style_names = []
+        self._file = None
+        self._dump = None
+        self._reset()
+
+    def _reset(self):
+        self.size = 0
+        self._lengths = array('H')
+        self._values = []
+        self._styles = []
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values, styles):
+        """Append a row of `values` with the names of their `styles`."""
+        lengths = self._lengths
+        columns = self._values
+        column_styles = self._styles
+        style_ids = self._style_ids
+        num = len(values)
+        while len(columns) < num:
+            # cells missing in the previous rows are padded with None
+            columns.append([None] * len(lengths))
+            column_styles.append(array('B', [0]) * len(lengths))
+        size = 2 + 9 * len(columns)
+        for idx, value in enumerate(values):
+            style_id = style_ids.get(styles[idx])
+            if style_id is None:
+                style_id = self._add_style(styles[idx])
+            columns[idx].append(value)
+            column_styles[idx].append(style_id)
+            if isinstance(value, basestring):
+                size += sys.getsizeof(value)
+        for idx in xrange(num, len(columns)):
+            columns[idx].append(None)
+            column_styles[idx].append(0)
+        lengths.append(num)
+        self._count += 1
+        self.size += size
+        if 0 < self.max_size < self.size:
+            self._spill()
+
+    def _add_style(self, name):
+        style_id = len(self._style_names)
+        self._style_names.append(name)
+        self._style_ids[name] = style_id
+        return style_id
+
+    def _spill(self):
+        if self._file is None:
+            self._file = TemporaryFile(dir=get_work_dir(self.env, 'tmp'))
+            pickler = cPickle.Pickler(self._file, cPickle.HIGHEST_PROTOCOL)
+            pickler.fast = True  # no memo which would keep the rows alive
+            self._dump = pickler.dump
+        self._dump((self._lengths.tostring(),
+                    [styles.tostring() for styles in self._styles],
+                    self._values))
+        self._reset()
+
+    def __iter__(self):
+        f = self._file
+        if f is not None:
+            f.seek(0)
+            load = cPickle.Unpickler(f).load
+            while True:
+                try:
+                    lengths, styles, values = load()
+                except EOFError:
+                    break
+                lengths = array('H', lengths)
+                styles = [array('B', column) for column in styles]
+                for row in self._iter_block(lengths, styles, values):
+                    yield row
+        for row in self._iter_block(self._lengths, self._styles,
+                                    self._values):
+            yield row
+
+    def _iter_block(self, lengths, styles, values):
+        if not values:  # only empty rows
+            for length in lengths:
+                yield (), ()
+            return
+        names = self._style_names
+        for length, row, ids in izip(lengths, izip(*values), izip(*styles)):
+            yield row[:length], [names[id] for id in ids[:length]]
+
+    def close(self):
+        self._reset()
+        self._count = 0
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._dump = None
 
 
 class XlwtWorkbookWriter(AbstractWorkbookWriter):
@@ -406,11 +1159,17 @@ class XlwtWorkbookWriter(AbstractWorkbookWriter):
     ext = 'xls'
     mimetype = 'application/vnd.ms-excel'
 
+    _hyperlink_tail = None  # tokens following the arguments of HYPERLINK
+
     def __init__(self, env, req):
-        if not xlwt:
+        try:
+            import xlwt
+            from xlwt.UnicodeUtils import upack1
+        except ImportError:
             raise TracError('Require xlwt library')
         book = xlwt.Workbook(encoding='utf-8', style_compression=1)
         AbstractWorkbookWriter.__init__(self, env, req, book)
+        self._upack1 = upack1
 
     def create_sheet(self, title):
         sheet = self.book.add_sheet(title)
@@ -419,7 +1178,36 @@ class XlwtWorkbookWriter(AbstractWorkbookWriter):
     def dump(self, out):
         self.book.save(out)
 
+    def resolve_style(self, name):
+        return self.styles[AbstractWorkbookWriter.resolve_style(self, name)]
+
+    def hyperlink_formula(self, link):
+        """Return the formula of `link`, or its label if the url or the
+        label doesn't fit in a string token of the formula.
+        """
+        if len(link.url) > 255 or len(link.label) > 255:
+            return link.label
+        upack1 = self._upack1
+        tail = self._hyperlink_tail
+        if tail is None:
+            tail = self._parse_hyperlink_tail()
+        tokens = ''.join(('\x17', upack1(link.url),  # tStr
+                          '\x17', upack1(link.label), tail))
+        return _XlwtFormula(link.formula, tokens)
+
+    @classmethod
+    def _parse_hyperlink_tail(cls):
+        from xlwt import Formula
+        from xlwt.UnicodeUtils import upack1
+        head = ''.join(('\x17', upack1(u'url'), '\x17', upack1(u'label')))
+        tokens = Formula('HYPERLINK("url","label")').rpn()[2:]
+        if not tokens.startswith(head):
+            raise ValueError('Unexpected tokens of HYPERLINK: %r' % tokens)
+        cls._hyperlink_tail = tail = tokens[len(head):]
+        return tail
+
     def _get_excel_styles(self):
+        import xlwt
         Alignment = xlwt.Alignment
         SOLID_PATTERN = xlwt.Pattern.SOLID_PATTERN
         THIN = xlwt.Borders.THIN
@@ -522,6 +1310,30 @@ class XlwtWorkbookWriter(AbstractWorkbookWriter):
         return styles
 
 
+class _XlwtFormula(object):
+    """Formula for `xlwt.Row.set_cell_formula()` from prebuilt tokens,
+    without parsing the formula text.
+    """
+
+    __slots__ = ('_get_text', '_rpn')
+
+    def __init__(self, get_text, tokens):
+        self._get_text = get_text
+        self._rpn = struct.pack('<H', len(tokens)) + tokens
+
+    def get_references(self):
+        return (), ()
+
+    def patch_references(self, patches):
+        pass
+
+    def text(self):
+        return self._get_text()
+
+    def rpn(self):
+        return self._rpn
+
+
 class XlwtWorksheetWriter(AbstractWorksheetWriter):
 
     MAX_ROWS = 65536
@@ -542,6 +1354,7 @@ class XlwtWorksheetWriter(AbstractWorksheetWriter):
         get_metrics = self.get_metrics
         tz = self.tz
         has_tz_normalize = hasattr(tz, 'normalize')  # pytz
+        writer = self.writer
 
         row = self.sheet.row(self.row_idx)
         max_line = 1
@@ -552,12 +1365,8 @@ class XlwtWorksheetWriter(AbstractWorksheetWriter):
                 if has_tz_normalize:
                     value = tz.normalize(value)
                 value = datetime(*(value.timetuple()[0:6]))
-                if style == '[date]':
-                    width = len('YYYY-MM-DD')
-                elif style == '[time]':
-                    width = len('HH:MM:SS')
-                else:
-                    width = len('YYYY-MM-DD HH:MM:SS')
+                if width is None:
+                    width = _get_datetime_width(style)
                 _set_col_width(idx, width)
                 row.set_cell_date(idx, value, _get_style(style))
                 continue
@@ -571,6 +1380,11 @@ class XlwtWorksheetWriter(AbstractWorksheetWriter):
                 continue
             if isinstance(value, basestring):
                 value = self._normalize_text(value)
+            elif isinstance(value, Hyperlink):
+                if width is None:
+                    width = get_metrics(value.label)[0]
+                line = 1
+                value = writer.hyperlink_formula(value)
             if width is None or line is None:
                 metrics = get_metrics(value)
                 if width is None:
@@ -583,7 +1397,10 @@ class XlwtWorksheetWriter(AbstractWorksheetWriter):
             style = _get_style(style)
             if max_height < style.font.height:
                 max_height = style.font.height
-            row.write(idx, value, style)
+            if isinstance(value, _XlwtFormula):
+                row.set_cell_formula(idx, value, style)
+            else:
+                row.write(idx, value, style)
             self._cells_count += 1
         row.height = min(max_line, 10) * max(max_height * 255 / 180, 255)
         row.height_mismatch = True
@@ -596,14 +1413,609 @@ class XlwtWorksheetWriter(AbstractWorksheetWriter):
 
     def _get_style(self, style):
         if isinstance(style, basestring):
-            if style not in self.styles:
-                if style.endswith(':change'):
-                    style = '*:change'
-                else:
-                    style = '*'
-            style = self.styles[style]
+            style = self.writer.resolve_style(style)
         return style
 
     def set_col_widths(self):
         for idx, width in self._col_widths.iteritems():
             self.sheet.col(idx).width = (1 + min(width, 50)) * 256
+
+
+def _xml_escape(text):
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+               .replace(u'>', u'&gt;').replace(u'"', u'&quot;')
+
+
+def _column_letter(idx):
+    letter = ''
+    idx += 1
+    while idx > 0:
+        idx, rem = divmod(idx - 1, 26)
+        letter = chr(ord('A') + rem) + letter
+    return letter
+
+
+def _deflate_part(args):
+    """Compress `head`, the content of file `f` and `tail` into file `out`
+    as a raw deflate stream, and return a tuple of the CRC, the size and
+    the compressed size. This runs in a worker thread of
+    `SpreadsheetMLWorkbookWriter`.
+    """
+    head, f, tail, out, level = args
+    cmpr = zlib.compressobj(level, zlib.DEFLATED, -15)
+    CRC = file_size = compress_size = 0
+    f.seek(0)
+    out.seek(0)
+    for buf in chain([head], iter(lambda: f.read(65536), ''), [tail]):
+        file_size += len(buf)
+        CRC = zlib.crc32(buf, CRC) & 0xffffffff
+        buf = cmpr.compress(buf)
+        compress_size += len(buf)
+        out.write(buf)
+    buf = cmpr.flush()
+    compress_size += len(buf)
+    out.write(buf)
+    return CRC, file_size, compress_size
+
+
+class _ZipFile(zipfile.ZipFile):
+
+    compresslevel = zlib.Z_DEFAULT_COMPRESSION
+
+    def _start_entry(self, arcname, compress_type):
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[0:6])
+        zinfo.external_attr = 0600 << 16L
+        if compress_type is None:
+            zinfo.compress_type = self.compression
+        else:
+            zinfo.compress_type = compress_type
+        zinfo.file_size = 0
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = self.fp.tell()
+
+        self._writecheck(zinfo)
+        self._didModify = True
+        return zinfo
+
+    def _end_entry(self, zinfo):
+        if zinfo.file_size > zipfile.ZIP64_LIMIT or \
+                zinfo.compress_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Zipfile size would require ZIP64 '
+                                       'extensions')
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def iter_deflated(self, arcname, chunks, CRC, file_size, compress_size):
+        """Put the raw deflate stream from iterable `chunks` into the
+        archive under the name `arcname` and yield the bytes written to the
+        `_ZipOutput` of the archive. The CRC and the sizes of the stream
+        must be known in advance.
+        """
+        zinfo = self._start_entry(arcname, zipfile.ZIP_DEFLATED)
+        zinfo.CRC = CRC
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        self.fp.write(zinfo.FileHeader(False))
+        for buf in chunks:
+            self.fp.write(buf)
+            yield self.fp.drain()
+        self._end_entry(zinfo)
+
+    def iter_chunks(self, arcname, chunks, compress_type=None):
+        """Put the byte strings from iterable `chunks` into the archive
+        under the name `arcname` and yield the bytes written to the
+        `_ZipOutput` of the archive as they are compressed. The output
+        can't seek back to the local header, so the CRC and the sizes
+        follow the content in a data descriptor.
+        """
+        zinfo = self._start_entry(arcname, compress_type)
+        zinfo.flag_bits |= 0x08
+        zinfo.CRC = CRC = 0
+        zinfo.compress_size = compress_size = 0
+        self.fp.write(zinfo.FileHeader(False))
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            cmpr = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        else:
+            cmpr = None
+        file_size = 0
+        for buf in chunks:
+            if not buf:
+                continue
+            file_size += len(buf)
+            CRC = zlib.crc32(buf, CRC) & 0xffffffff
+            if cmpr:
+                buf = cmpr.compress(buf)
+                if not buf:
+                    continue
+                compress_size += len(buf)
+            self.fp.write(buf)
+            yield self.fp.drain()
+        if cmpr:
+            buf = cmpr.flush()
+            compress_size += len(buf)
+            self.fp.write(buf)
+            zinfo.compress_size = compress_size
+        else:
+            zinfo.compress_size = file_size
+        zinfo.CRC = CRC
+        zinfo.file_size = file_size
+        self.fp.write(struct.pack('<4L', 0x08074b50, CRC,
+                                  zinfo.compress_size, file_size))
+        self._end_entry(zinfo)
+        yield self.fp.drain()
+
+
+class _ZipOutput(object):
+    """Collect the bytes which `_ZipFile` writes until `drain()` takes
+    them, and count the offset in the archive in place of a file.
+    """
+
+    def __init__(self):
+        self._buf = []
+        self._offset = 0
+
+    def write(self, data):
+        self._buf.append(data)
+        self._offset += len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = ''.join(self._buf)
+        del self._buf[:]
+        return data
+
+
+class SpreadsheetMLWorkbookWriter(AbstractWorkbookWriter):
+    """Write xlsx files without third-party libraries. The rows of each
+    worksheet are serialized into a temporary file as they are written
+    and copied into the zip entry of the worksheet on `dump()`. Short
+    strings are deduplicated in the shared strings table of the workbook.
+    """
+
+    ext = 'xlsx'
+    mimetype = OpenpyxlWorkbookWriter.mimetype
+    parallel_min_size = 1048576  # of the sheets compressed in threads
+
+    _xml_decl = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    _main_ns = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    _rels_ns = 'http://schemas.openxmlformats.org/package/2006/relationships'
+    _doc_rels_ns = 'http://schemas.openxmlformats.org/officeDocument/2006/' \
+                   'relationships'
+    _content_types_ns = 'http://schemas.openxmlformats.org/package/2006/' \
+                        'content-types'
+    _ct_prefix = 'application/vnd.openxmlformats-officedocument.' \
+                 'spreadsheetml.'
+
+    # fonts: 0: 9pt, 1: 20pt, 2: 16pt, 3: 9pt bold white
+    _fonts = ((9, False, None), (20, False, None), (16, False, None),
+              (9, True, 'FFFFFFFF'))
+    # fills: 0 and 1 are reserved by Excel, 2: black, 3: orange
+    _fills = (None, 'gray125', 'FF000000', 'FFFF9900')
+    # borders: 0: none, 1: thin black, 2: thin white
+    _borders = (None, 'FF000000', 'FFFFFFFF')
+    # name: (font, fill, border, number format, alignment)
+    _style_specs = (
+        ('header',     (1, 0, 0, None, None)),
+        ('header2',    (2, 0, 0, None, None)),
+        ('thead',      (3, 2, 2, None, None)),
+        ('id',         (0, 0, 1, '"#"0', 'vertical="top" horizontal="right"')),
+        ('milestone',  (0, 0, 1, '@', 'vertical="top" wrapText="1"')),
+        ('[time]',     (0, 0, 1, 'HH:MM:SS', 'vertical="top" wrapText="1"')),
+        ('[date]',     (0, 0, 1, 'YYYY-MM-DD', 'vertical="top" wrapText="1"')),
+        ('[datetime]', (0, 0, 1, 'YYYY-MM-DD HH:MM:SS',
+                        'vertical="top" wrapText="1"')),
+        ('*',          (0, 0, 1, '@', 'vertical="top" wrapText="1"')),
+    )
+
+    # strings up to this length are written to the shared strings table,
+    # longer strings are mostly unique and are written inline
+    shared_string_max_len = 64
+
+    def __init__(self, env, req):
+        AbstractWorkbookWriter.__init__(self, env, req, [])
+        self.shared_strings = {}  # string -> index
+        self.shared_strings_count = 0
+        self._templates = {}
+
+    def resolve_style(self, name):
+        """Return the cell XML templates for the style `name`. Each template
+        takes the cell reference and the serialized value.
+        """
+        templates = self._templates.get(name)
+        if templates is None:
+            s = self.styles[AbstractWorkbookWriter.resolve_style(self, name)]
+            templates = {
+                'n': u'<c r="%%s" s="%d"><v>%%s</v></c>' % s,
+                'b': u'<c r="%%s" s="%d" t="b"><v>%%s</v></c>' % s,
+                's': u'<c r="%%s" s="%d" t="s"><v>%%d</v></c>' % s,
+                'str': u'<c r="%%s" s="%d" t="inlineStr"><is>'
+                       u'<t xml:space="preserve">%%s</t></is></c>' % s,
+                'f': u'<c r="%%s" s="%d" t="str"><f>%%s</f>'
+                     u'<v>%%s</v></c>' % s,
+            }
+            self._templates[name] = templates
+        return templates
+
+    def create_sheet(self, title):
+        writer = SpreadsheetMLWorksheetWriter(title, self)
+        self.book.append(writer)
+        return writer
+
+    def dump(self, out):
+        for data in self._iter_archive():
+            out.write(data)
+
+    def iterdump(self, chunk_size=65536):
+        """Return a tuple of `None`, as the size isn't known in advance,
+        and an iterator which yields the archive while its entries are
+        written, without spooling the workbook.
+        """
+        return None, self._iter_archive()
+
+    def _iter_archive(self):
+        sheets = self.book
+        level = ExcelDownloadConfig(self.env).xlsx_compression_level
+        level = max(-1, min(level, 9))
+        out = _ZipOutput()
+        if level == 0:
+            archive = _ZipFile(out, 'w', zipfile.ZIP_STORED)
+        else:
+            archive = _ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+            archive.compresslevel = level
+        parts = None
+        try:
+            write = archive.iter_chunks
+            entries = [
+                write('[Content_Types].xml', [self._content_types_xml()]),
+                write('_rels/.rels', [self._root_rels_xml()]),
+                write('xl/workbook.xml', [self._workbook_xml()]),
+                write('xl/_rels/workbook.xml.rels',
+                      [self._workbook_rels_xml()]),
+                write('xl/styles.xml', [self._styles_xml]),
+            ]
+            parts = self._deflate_sheets(level) if level != 0 else None
+            for idx, sheet in enumerate(sheets):
+                arcname = 'xl/worksheets/sheet%d.xml' % (idx + 1)
+                if parts:
+                    f, CRC, file_size, compress_size = parts[idx]
+                    entries.append(archive.iter_deflated(
+                        arcname, _iter_file(f), CRC, file_size,
+                        compress_size))
+                else:
+                    entries.append(write(arcname, sheet.iter_xml()))
+            entries.append(write('xl/sharedStrings.xml',
+                                 self._iter_shared_strings_xml()))
+            for data in chain.from_iterable(entries):
+                if data:
+                    yield data
+            archive.close()
+            yield out.drain()
+        finally:
+            archive.close()
+            for part in parts or ():
+                part[0].close()
+            for sheet in sheets:
+                sheet.close()
+
+    def _deflate_sheets(self, level):
+        """Compress the worksheet parts in worker threads when enabled and
+        return a list of tuples of the file with the raw deflate stream,
+        the CRC, the size and the compressed size of each part. Return
+        `None` when the parts are to be compressed while writing the
+        archive.
+
+        zlib releases the GIL while deflating, so the threads compress
+        the sheets in parallel. Worker processes would fork the web
+        server process, which may be threaded, and copy the locks held by
+        its other threads and its database connections.
+        """
+        sheets = self.book
+        threads = min(ExcelDownloadConfig(self.env).sheet_threads,
+                      len(sheets))
+        if threads < 2:
+            return None
+        size = 0
+        for sheet in sheets:
+            sheet.sheet.seek(0, 2)
+            size += sheet.sheet.tell()
+        if size < self.parallel_min_size:
+            return None  # not worth starting the threads
+        from multiprocessing.pool import ThreadPool
+        outs = []
+        try:
+            args = []
+            for sheet in sheets:
+                out = TemporaryFile()
+                outs.append(out)
+                args.append((sheet.xml_head(), sheet.sheet, sheet.xml_tail,
+                             out, level))
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(_deflate_part, args)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        except:
+            for out in outs:
+                out.close()
+            raise
+        for out in outs:
+            out.seek(0)
+        return [(out,) + result for out, result in zip(outs, results)]
+
+    def _content_types_xml(self):
+        ct = self._ct_prefix
+        overrides = [('/xl/workbook.xml', ct + 'sheet.main+xml'),
+                     ('/xl/styles.xml', ct + 'styles+xml'),
+                     ('/xl/sharedStrings.xml', ct + 'sharedStrings+xml')]
+        overrides.extend(('/xl/worksheets/sheet%d.xml' % (idx + 1),
+                          ct + 'worksheet+xml')
+                         for idx in xrange(len(self.book)))
+        return ''.join(chain(
+            [self._xml_decl, '<Types xmlns="%s">' % self._content_types_ns,
+             '<Default Extension="rels" ContentType="application/'
+             'vnd.openxmlformats-package.relationships+xml"/>',
+             '<Default Extension="xml" ContentType="application/xml"/>'],
+            ('<Override PartName="%s" ContentType="%s"/>' % item
+             for item in overrides),
+            ['</Types>']))
+
+    def _root_rels_xml(self):
+        return ''.join([
+            self._xml_decl, '<Relationships xmlns="%s">' % self._rels_ns,
+            '<Relationship Id="rId1" Type="%s/officeDocument" '
+            'Target="xl/workbook.xml"/>' % self._doc_rels_ns,
+            '</Relationships>'])
+
+    def _workbook_xml(self):
+        return ''.join(chain(
+            [self._xml_decl,
+             '<workbook xmlns="%s" xmlns:r="%s"><sheets>' %
+             (self._main_ns, self._doc_rels_ns)],
+            ('<sheet name="%s" sheetId="%d" r:id="rId%d"/>' %
+             (_xml_escape(sheet.title).encode('utf-8'), idx + 1, idx + 1)
+             for idx, sheet in enumerate(self.book)),
+            ['</sheets></workbook>']))
+
+    def _workbook_rels_xml(self):
+        num = len(self.book)
+        return ''.join(chain(
+            [self._xml_decl, '<Relationships xmlns="%s">' % self._rels_ns],
+            ('<Relationship Id="rId%d" Type="%s/worksheet" '
+             'Target="worksheets/sheet%d.xml"/>' %
+             (idx + 1, self._doc_rels_ns, idx + 1) for idx in xrange(num)),
+            ['<Relationship Id="rId%d" Type="%s/styles" '
+             'Target="styles.xml"/>' % (num + 1, self._doc_rels_ns),
+             '<Relationship Id="rId%d" Type="%s/sharedStrings" '
+             'Target="sharedStrings.xml"/>' % (num + 2, self._doc_rels_ns),
+             '</Relationships>']))
+
+    def _iter_shared_strings_xml(self, chunk_size=65536):
+        strings = self.shared_strings
+        yield ''.join([self._xml_decl,
+                       '<sst xmlns="%s" count="%d" uniqueCount="%d">' %
+                       (self._main_ns, self.shared_strings_count,
+                        len(strings))])
+        items = sorted(strings.iteritems(), key=lambda item: item[1])
+        buf = []
+        size = 0
+        for value, index in items:
+            item = u'<si><t xml:space="preserve">%s</t></si>' % \
+                   _xml_escape(value)
+            buf.append(item)
+            size += len(item)
+            if size >= chunk_size:
+                yield u''.join(buf).encode('utf-8')
+                buf = []
+                size = 0
+        buf.append(u'</sst>')
+        yield u''.join(buf).encode('utf-8')
+
+    def _get_excel_styles(self):
+        num_fmts = []
+        xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" '
+               'xfId="0"/>']
+        styles = {}
+
+        def add_xf(name, font, fill, border, num_fmt, alignment):
+            if num_fmt is None:
+                num_fmt_id = 0
+            elif num_fmt == '@':
+                num_fmt_id = 49
+            else:
+                if num_fmt not in num_fmts:
+                    num_fmts.append(num_fmt)
+                num_fmt_id = 164 + num_fmts.index(num_fmt)
+            xf = '<xf numFmtId="%d" fontId="%d" fillId="%d" borderId="%d" ' \
+                 'xfId="0" applyNumberFormat="1" applyFont="1" ' \
+                 'applyFill="1" applyBorder="1"' % \
+                 (num_fmt_id, font, fill, border)
+            if alignment:
+                xf += ' applyAlignment="1"><alignment %s/></xf>' % alignment
+            else:
+                xf += '/>'
+            styles[name] = len(xfs)
+            xfs.append(xf)
+
+        for name, spec in self._style_specs:
+            add_xf(name, *spec)
+            font, fill, border, num_fmt, alignment = spec
+            add_xf('%s:change' % name, font, 3, border, num_fmt, alignment)
+
+        def font_xml(size, bold, color):
+            return '<font>%s<sz val="%d"/>%s<name val="Arial"/></font>' % \
+                   ('<b/>' if bold else '', size,
+                    '<color rgb="%s"/>' % color if color else '')
+
+        def fill_xml(fill):
+            if fill is None:
+                return '<fill><patternFill patternType="none"/></fill>'
+            if fill == 'gray125':
+                return '<fill><patternFill patternType="gray125"/></fill>'
+            return '<fill><patternFill patternType="solid">' \
+                   '<fgColor rgb="%s"/></patternFill></fill>' % fill
+
+        def border_xml(color):
+            if color is None:
+                return '<border><left/><right/><top/><bottom/><diagonal/>' \
+                       '</border>'
+            side = '<%%s style="thin"><color rgb="%s"/></%%s>' % color
+            return '<border>%s<diagonal/></border>' % \
+                   ''.join(side % (name, name)
+                           for name in ('left', 'right', 'top', 'bottom'))
+
+        self._styles_xml = ''.join(chain(
+            [self._xml_decl, '<styleSheet xmlns="%s">' % self._main_ns,
+             '<numFmts count="%d">' % len(num_fmts)],
+            ('<numFmt numFmtId="%d" formatCode="%s"/>' %
+             (164 + idx, _xml_escape(num_fmt))
+             for idx, num_fmt in enumerate(num_fmts)),
+            ['</numFmts><fonts count="%d">' % len(self._fonts)],
+            (font_xml(*font) for font in self._fonts),
+            ['</fonts><fills count="%d">' % len(self._fills)],
+            (fill_xml(fill) for fill in self._fills),
+            ['</fills><borders count="%d">' % len(self._borders)],
+            (border_xml(border) for border in self._borders),
+            ['</borders><cellStyleXfs count="1"><xf numFmtId="0" fontId="0" '
+             'fillId="0" borderId="0"/></cellStyleXfs>'
+             '<cellXfs count="%d">' % len(xfs)],
+            xfs,
+            ['</cellXfs><cellStyles count="1"><cellStyle name="Normal" '
+             'xfId="0" builtinId="0"/></cellStyles></styleSheet>']))
+        return styles
+
+
+class SpreadsheetMLWorksheetWriter(AbstractWorksheetWriter):
+
+    MAX_ROWS = 1048576
+    MAX_COLS = 16384
+    MAX_CHARS = 32767
+
+    _epoch = datetime(1899, 12, 30)
+
+    def __init__(self, title, writer):
+        AbstractWorksheetWriter.__init__(self, TemporaryFile(), writer)
+        self.title = title
+        self._letters = []
+
+    def _get_templates(self, style):
+        if isinstance(style, dict):
+            return style  # resolved by `resolve_style()`
+        return self.writer.resolve_style(style)
+
+    def _get_letter(self, idx):
+        letters = self._letters
+        while len(letters) <= idx:
+            letters.append(_column_letter(len(letters)))
+        return letters[idx]
+
+    def write_row(self, cells):
+        get_metrics = self.get_metrics
+        get_templates = self._get_templates
+        get_letter = self._get_letter
+        set_col_width = self._set_col_width
+        tz = self.tz
+        has_tz_normalize = hasattr(tz, 'normalize')  # pytz
+        row_num = self.row_idx + 1
+        writer = self.writer
+        shared_strings = writer.shared_strings
+        shared_string_max_len = writer.shared_string_max_len
+
+        values = []
+        for idx, (value, style, width, line) in enumerate(cells):
+            templates = get_templates(style)
+            if isinstance(value, datetime):
+                value = value.astimezone(tz)
+                if has_tz_normalize:
+                    value = tz.normalize(value)
+                value = datetime(*(value.timetuple()[0:6])) - self._epoch
+                value = value.days + value.seconds / 86400.0
+                if width is None:
+                    width = _get_datetime_width(style)
+                template = templates['n']
+                value = repr(value)
+                width /= 1.2
+            elif value is True or value is False:
+                width = 5 / 1.2
+                template = templates['b']
+                value = ('0', '1')[value]
+            elif isinstance(value, (int, long, float, Decimal)):
+                width = len('%g' % value) / 1.2
+                template = templates['n']
+                value = repr(value) if isinstance(value, float) \
+                                    else str(value)
+            elif isinstance(value, basestring) or value is None:
+                value = self._normalize_text(value or u'')
+                if width is None:
+                    width = get_metrics(value)[0]
+                if len(value) <= shared_string_max_len:
+                    template = templates['s']
+                    index = shared_strings.get(value)
+                    if index is None:
+                        index = shared_strings[value] = len(shared_strings)
+                    writer.shared_strings_count += 1
+                    value = index
+                else:
+                    template = templates['str']
+                    value = _xml_escape(value)
+            elif isinstance(value, Hyperlink):
+                label = self._normalize_text(value.label)
+                if width is None:
+                    width = get_metrics(label)[0]
+                set_col_width(idx, width)
+                values.append(templates['f'] %
+                              (get_letter(idx) + str(row_num),
+                               _xml_escape(value.formula()),
+                               _xml_escape(label)))
+                continue
+            else:
+                raise TypeError('Unexpected data type %r' % type(value))
+            set_col_width(idx, width)
+            values.append(template % (get_letter(idx) + str(row_num), value))
+
+        self.sheet.write(''.join(chain([u'<row r="%d">' % row_num], values,
+                                       [u'</row>'])).encode('utf-8'))
+        self.row_idx += 1
+
+    def set_col_widths(self):
+        pass
+
+    def iter_xml(self, chunk_size=65536):
+        """Yield the worksheet XML in chunks."""
+        yield self.xml_head()
+        self.sheet.seek(0)
+        while True:
+            chunk = self.sheet.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        yield self.xml_tail
+
+    xml_tail = '</sheetData></worksheet>'
+
+    def xml_head(self):
+        """Return the worksheet XML which precedes the rows."""
+        writer = self.writer
+        head = [writer._xml_decl,
+                '<worksheet xmlns="%s"><sheetViews><sheetView workbookViewId='
+                '"0"/></sheetViews><sheetFormatPr defaultRowHeight="15"/>' %
+                writer._main_ns]
+        if self._col_widths:
+            head.append('<cols>')
+            head.extend('<col min="%d" max="%d" width="%s" customWidth="1"/>'
+                        % (idx + 1, idx + 1, 1 + min(width, 50))
+                        for idx, width in sorted(self._col_widths.iteritems()))
+            head.append('</cols>')
+        head.append('<sheetData>')
+        return ''.join(head)
+
+    def close(self):
+        self.sheet.close()
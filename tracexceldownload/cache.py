@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import time
+from hashlib import sha1
+from tempfile import mkstemp
+from threading import Lock
+
+from trac.core import Component
+from trac.util.text import to_utf8
+
+from tracexceldownload.api import (ExcelDownloadConfig, _iter_file,
+                                   get_work_dir)
+
+
+class ExcelDownloadCache(Component):
+    """Cache of generated Excel files in the environment directory.
+
+    Entries are evicted when they are older than `[exceldownload]
+    cache_max_age`, and least recently used entries are evicted while the
+    total size exceeds `[exceldownload] cache_size`.
+    """
+
+    # the settings which change the content of the generated files
+    _config_sections = ('exceldownload', 'ticket-custom')
+    _config_options = (('trac', 'show_email_addresses'),
+                       ('trac', 'show_full_names'))
+
+    def __init__(self):
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def enabled(self):
+        return ExcelDownloadConfig(self.env).cache_size > 0
+
+    def get_key(self, *parts):
+        """Return the cache key for `parts` and the settings which change
+        the generated files, or `None` when the cache is disabled.
+        """
+        if not self.enabled:
+            return None
+        config = self.env.config
+        settings = [(section, sorted(config.options(section)))
+                    for section in self._config_sections]
+        settings.extend((section, name, config.get(section, name))
+                        for section, name in self._config_options)
+        parts += (settings,)
+        return sha1('\0'.join(to_utf8(unicode(part))
+                              for part in parts)).hexdigest()
+
+    def fetch(self, key):
+        """Return a tuple of the size and a chunk iterator of the cached
+        content for `key`, or `None` if the content isn't cached.
+        """
+        path = self._get_path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            f = None
+        else:
+            size = os.fstat(f.fileno()).st_size
+            max_age = ExcelDownloadConfig(self.env).cache_max_age
+            if os.fstat(f.fileno()).st_mtime + max_age < time.time():
+                f.close()
+                f = None
+        with self._lock:
+            if f:
+                self._hits += 1
+            else:
+                self._misses += 1
+            self.log.debug("Excel download cache %s (hits %d, misses %d)",
+                           ('miss', 'hit')[bool(f)], self._hits,
+                           self._misses)
+        if not f:
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        return size, _iter_file(f)
+
+    def store(self, key, book):
+        """Dump `book` into the cache for `key` and return a tuple of the
+        size and a chunk iterator of the content.
+        """
+        dir = get_work_dir(self.env, 'cache')
+        fd, tmp = mkstemp(dir=dir, suffix='.tmp')
+        f = os.fdopen(fd, 'w+b')
+        try:
+            book.dump(f)
+            f.flush()
+            size = os.fstat(f.fileno()).st_size
+            path = self._get_path(key)
+            if os.name == 'nt':
+                # an open file can't be renamed on Windows, where an
+                # eviction can't remove the reopened file either
+                f.close()
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp, path)
+                f = open(path, 'rb')
+            else:
+                # the content is read from the file still open, which a
+                # concurrent eviction may remove once it's renamed
+                os.rename(tmp, path)
+                f.seek(0)
+        except:
+            f.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._evict()
+        return size, _iter_file(f)
+
+    def _get_path(self, key):
+        return os.path.join(get_work_dir(self.env, 'cache'), key)
+
+    def _evict(self):
+        config = ExcelDownloadConfig(self.env)
+        dir = get_work_dir(self.env, 'cache')
+        expires = time.time() - config.cache_max_age
+        entries = []
+        for name in os.listdir(dir):
+            path = os.path.join(dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp') and st.st_mtime >= expires:
+                continue  # being written
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort(reverse=True)
+        total = 0
+        evicted = 0
+        for mtime, size, path in entries:
+            if mtime >= expires and total + size <= config.cache_size:
+                total += size
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            evicted += 1
+        if evicted:
+            self.log.debug("Evicted %d Excel files from the cache", evicted)
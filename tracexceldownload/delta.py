@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import time
+from binascii import hexlify
+
+from trac.core import Component, TracError
+from trac.util.datefmt import from_utimestamp, parse_date, to_utimestamp
+
+from tracexceldownload.api import ExcelDownloadConfig, get_work_dir
+from tracexceldownload.translation import _
+
+
+class ExcelDeltaTokens(Component):
+    """Tokens of delta exports in the environment directory.
+
+    A token remembers the time of an export and the tickets which it
+    contained, so the next export can be restricted to the tickets changed
+    since then and report the tickets which were deleted or hidden.
+    """
+
+    _match_token = re.compile(r'[0-9a-f]{32}\Z').match
+
+    def parse_since(self, req, since, query_string):
+        """Return a tuple of the time and the set of previously exported
+        ticket ids for the `since` argument of an export of `query_string`.
+        `since` is a token, a date or an empty string for a full export.
+        The set is `None` unless `since` is a token.
+        """
+        if not since:
+            return None, None
+        if self._match_token(since):
+            data = self._read(since)
+            if not data or data['owner'] != req.authname or \
+                    data['query'] != query_string:
+                raise TracError(_("The delta export token is invalid or "
+                                  "has expired."))
+            return from_utimestamp(data['time']), set(data['ids'])
+        return parse_date(since, req.tz), None
+
+    def issue(self, req, query_string, when, tkt_ids):
+        """Store the tickets `tkt_ids` exported at `when` and return the
+        token for the next delta export.
+        """
+        self._cleanup()
+        token = hexlify(os.urandom(16))
+        self._write(token, {'owner': req.authname, 'query': query_string,
+                            'time': to_utimestamp(when),
+                            'ids': sorted(tkt_ids)})
+        return token
+
+    def _get_path(self, token):
+        return os.path.join(get_work_dir(self.env, 'delta'), token + '.json')
+
+    def _read(self, token):
+        max_age = ExcelDownloadConfig(self.env).delta_token_max_age
+        try:
+            with open(self._get_path(token), 'rb') as f:
+                if os.fstat(f.fileno()).st_mtime + max_age < time.time():
+                    return None
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, token, data):
+        path = self._get_path(token)
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    def _cleanup(self):
+        dir = get_work_dir(self.env, 'delta')
+        max_age = ExcelDownloadConfig(self.env).delta_token_max_age
+        expires = time.time() - max_age
+        for name in os.listdir(dir):
+            path = os.path.join(dir, name)
+            try:
+                if os.stat(path).st_mtime < expires:
+                    os.remove(path)
+            except OSError:
+                pass
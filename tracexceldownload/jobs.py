@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import json
+import os
+import re
+import time
+from binascii import hexlify
+from Queue import Full, Queue
+from threading import Lock, Thread
+
+from trac.core import Component, TracError, implements
+from trac.util import content_disposition
+from trac.util.html import escape
+from trac.util.text import exception_to_unicode
+from trac.web.api import HTTPNotFound, IRequestHandler
+
+from tracexceldownload.api import ExcelDownloadConfig, get_work_dir
+from tracexceldownload.translation import _
+
+
+class _JobRequest(object):
+    """Snapshot of the request of a background export, taken while the
+    request is alive. The response has been sent when the export runs, so
+    sending headers or content raises an error instead of being lost.
+    """
+
+    def __init__(self, req):
+        self.authname = req.authname
+        self.perm = req.perm
+        self.tz = req.tz
+        self.locale = getattr(req, 'locale', None)
+        self.lc_time = getattr(req, 'lc_time', None)
+        self.href = req.href
+        self.abs_href = req.abs_href
+        self.args = copy.copy(req.args)
+        # exempt the export from the time budget and the checks of the
+        # client connection
+        self.environ = {'tracexceldownload.background': True}
+        # sent with the file when it's downloaded, see `send_file_header`
+        self.file_headers = []
+
+    def _answered(self, *args, **kwargs):
+        raise RuntimeError("The response to the request of a background "
+                           "export has already been sent")
+
+    send_response = send_header = end_headers = write = send = \
+        send_file = redirect = _answered
+
+
+class ExcelExportJobModule(Component):
+    """Generate Excel files in a bounded pool of threads and let the client
+    poll for the result.
+
+    A job runs in the process which queued it, and that process touches
+    the metadata file of its unfinished jobs as a heartbeat. Any process
+    sharing the environment can answer the polls, and reports a job
+    without a recent heartbeat as failed, e.g. when its process was
+    restarted.
+    """
+
+    implements(IRequestHandler)
+
+    _job_max_age = 86400
+    _heartbeat_interval = 10
+    _job_stale_age = 60
+
+    def __init__(self):
+        self._lock = Lock()
+        self._queue = None
+        self._jobs = set()  # ids of the unfinished jobs of this process
+
+    def is_requested(self, req):
+        """Return `True` if `req` asks for a background export and background
+        exports are enabled.
+        """
+        return bool(req.args.get('background')) and \
+               ExcelDownloadConfig(self.env).background_workers > 0
+
+    def enqueue(self, req, filename, fn):
+        """Run `fn` in the background and redirect the client to the status
+        page of the job. `fn` is called with a snapshot of `req` and must
+        return a tuple of the content and the mimetype like
+        `IContentConverter.convert_content`.
+        """
+        job_req = _JobRequest(req)
+        self._cleanup()
+        job_id = hexlify(os.urandom(16))
+        self._write_meta(job_id, {'owner': req.authname,
+                                  'filename': filename,
+                                  'queued': time.time()})
+        queue = self._get_queue()
+        with self._lock:
+            self._jobs.add(job_id)
+        try:
+            queue.put_nowait((job_id, fn, job_req))
+        except Full:
+            with self._lock:
+                self._jobs.discard(job_id)
+            os.remove(self._get_path(job_id, 'json'))
+            raise TracError(_("Too many Excel exports are in progress. "
+                              "Please try again later."))
+        self.log.debug("Queued Excel export job %s", job_id)
+        req.redirect(req.href('exceldownload/job', job_id))
+
+    # IRequestHandler methods
+
+    _MATCH_REQUEST = re.compile(r'/exceldownload/job/([0-9a-f]{32})$').match
+
+    def match_request(self, req):
+        match = self._MATCH_REQUEST(req.path_info)
+        if match:
+            req.args['job_id'] = match.group(1)
+            return True
+
+    def process_request(self, req):
+        job_id = req.args['job_id']
+        path = self._get_path(job_id, 'out')
+        done = os.path.isfile(path)
+        meta = self._read_meta(job_id)
+        if not meta or meta['owner'] != req.authname:
+            raise HTTPNotFound(_("No such Excel export job"))
+        if 'error' in meta:
+            raise TracError(meta['error'])
+        if not done and self._is_stale(job_id):
+            raise TracError(_("The Excel export job was interrupted. "
+                              "Please export again."))
+        if req.args.get('format') == 'json':
+            data = {'status': ('pending', 'done')[done]}
+            if done:
+                data['href'] = req.href('exceldownload/job', job_id)
+            req.send(json.dumps(data), 'application/json')
+        if done:
+            for name, value in meta.get('headers', ()):
+                req.send_header(name, value)
+            req.send_header('Content-Disposition',
+                            content_disposition('attachment',
+                                                meta['filename']))
+            req.send_file(path, meta['mimetype'])
+        message = _("The Excel file is being generated. This page will "
+                    "reload until it is ready.")
+        req.send((u'<!DOCTYPE html><html><head>'
+                  u'<meta http-equiv="refresh" content="3"/></head>'
+                  u'<body><p>%s</p></body></html>' %
+                  escape(message)).encode('utf-8'),
+                 'text/html;charset=utf-8', 202)
+
+    # Internal methods
+
+    def _get_queue(self):
+        with self._lock:
+            if self._queue is None:
+                config = ExcelDownloadConfig(self.env)
+                self._queue = Queue(max(config.background_queue_size, 1))
+                for idx in xrange(config.background_workers):
+                    thread = Thread(target=self._run_jobs,
+                                    name='ExcelExportJob-%d' % idx)
+                    thread.daemon = True
+                    thread.start()
+                thread = Thread(target=self._run_heartbeat,
+                                name='ExcelExportJobHeartbeat')
+                thread.daemon = True
+                thread.start()
+            return self._queue
+
+    def _run_jobs(self):
+        queue = self._queue
+        while True:
+            job_id, fn, job_req = queue.get()
+            try:
+                self._run_job(job_id, fn, job_req)
+            except Exception, e:
+                self.log.error("Excel export job %s failed: %s", job_id,
+                               exception_to_unicode(e, traceback=True))
+            finally:
+                with self._lock:
+                    self._jobs.discard(job_id)
+
+    def _run_heartbeat(self):
+        while True:
+            time.sleep(self._heartbeat_interval)
+            self._touch_jobs()
+
+    def _touch_jobs(self):
+        with self._lock:
+            job_ids = list(self._jobs)
+        for job_id in job_ids:
+            try:
+                os.utime(self._get_path(job_id, 'json'), None)
+            except OSError:
+                pass
+
+    def _is_stale(self, job_id):
+        try:
+            mtime = os.stat(self._get_path(job_id, 'json')).st_mtime
+        except OSError:
+            return True
+        return mtime + self._job_stale_age < time.time()
+
+    def _run_job(self, job_id, fn, job_req):
+        meta = self._read_meta(job_id)
+        tmp = self._get_path(job_id, 'tmp')
+        try:
+            start = meta['started'] = time.time()
+            self._write_meta(job_id, meta)
+            content, mimetype = fn(job_req)
+            if isinstance(content, basestring):
+                content = (content,)
+            with open(tmp, 'wb') as f:
+                for chunk in content:
+                    f.write(chunk)
+            meta['mimetype'] = mimetype
+            meta['headers'] = job_req.file_headers
+            self._write_meta(job_id, meta)
+            os.rename(tmp, self._get_path(job_id, 'out'))
+            self.log.debug("Excel export job %s finished in %.3f seconds",
+                           job_id, time.time() - start)
+        except Exception, e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            meta['error'] = exception_to_unicode(e)
+            self._write_meta(job_id, meta)
+            raise
+
+    def _cleanup(self):
+        dir = get_work_dir(self.env, 'jobs')
+        expires = time.time() - self._job_max_age
+        for name in os.listdir(dir):
+            path = os.path.join(dir, name)
+            try:
+                if os.stat(path).st_mtime < expires:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _get_path(self, job_id, ext):
+        return os.path.join(get_work_dir(self.env, 'jobs'),
+                            '%s.%s' % (job_id, ext))
+
+    def _read_meta(self, job_id):
+        try:
+            with open(self._get_path(job_id, 'json'), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, job_id, meta):
+        path = self._get_path(job_id, 'json')
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(meta, f)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
@@ -16,7 +16,11 @@ else:
 
 
 def suite():
-    from tracexceldownload.tests import ticket
+    from tracexceldownload.tests import api, cache, delta, jobs, ticket
     suite = unittest.TestSuite()
+    suite.addTest(api.suite())
+    suite.addTest(cache.suite())
+    suite.addTest(delta.suite())
+    suite.addTest(jobs.suite())
     suite.addTest(ticket.suite())
     return suite
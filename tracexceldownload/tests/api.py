@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+import zipfile
+from cStringIO import StringIO
+from datetime import datetime
+from unicodedata import east_asian_width
+
+from trac.test import EnvironmentStub, MockRequest
+from trac.util.datefmt import utc
+from trac.web.api import RequestDone
+
+from tracexceldownload.api import (ExportAborted, ExportCanceller, Hyperlink,
+                                   _RowBuffer, _TextMetrics,
+                                   get_excel_format, get_workbook_writer)
+
+
+class TextMetricsTestCase(unittest.TestCase):
+
+    def _reference(self, value, ambiwidth):
+        doubles = ('WFA', 'WF')[ambiwidth == 1]
+        lines = value.splitlines()
+        width = max(sum((1, 2)[east_asian_width(ch) in doubles]
+                        for ch in line)
+                    for line in lines)
+        return min(width, 50), len(lines)
+
+    def test_metrics(self):
+        values = [u'a', u'abc\r\ndefgh\n', u'\u3042\u3044 x', u'\xb1' * 3,
+                  u'\uff21\n\u0410\u0411\u0412', u'x' * 49 + u'\u3042',
+                  u'\u3042' * 30, u'y' * 100, 'bytes\nstring']
+        for ambiwidth in (1, 2):
+            metrics = _TextMetrics(ambiwidth)
+            for value in values:
+                self.assertEqual(self._reference(unicode(value), ambiwidth),
+                                 metrics(value), repr(value))
+        self.assertEqual((0, 1), metrics(u''))
+        self.assertEqual((0, 1), metrics(None))
+
+    def test_cache_bounded(self):
+        metrics = _TextMetrics(1)
+        metrics.cache_size = 3
+        for value in (u'a', u'bb', u'ccc', u'a'):
+            metrics(value)
+        self.assertEqual(set([u'a', u'bb', u'ccc']), set(metrics._cache))
+        self.assertEqual((4, 1), metrics(u'dddd'))
+        self.assertEqual([u'dddd'], list(metrics._cache))
+        metrics(u'z' * 300)
+        self.assertEqual([u'dddd'], list(metrics._cache))
+
+
+class NormalizeTextTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+        self.env.config.set('exceldownload', 'format', 'xlsx-native')
+        book = get_workbook_writer(self.env, MockRequest(self.env))
+        self.writer = book.create_sheet('Sheet')
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _reference(self, value):
+        writer = self.writer
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        value = writer._invalid_chars_re.sub(u'\ufffd', value)
+        value = '\n'.join(line.rstrip() for line in value.splitlines())
+        if len(value) > writer.MAX_CHARS:
+            value = value[:writer.MAX_CHARS - 1] + u'\u2026'
+        return value
+
+    def test_normalize(self):
+        values = [u'', u'new', 'defect', u'a\nb', u'a \nb', u'a\n', u'a\r\nb',
+                  u'a\x01b', u'a\u3000', u'\u3000a', u'a\u2028b', u'\n\n',
+                  u'x' * 40000, u'a\tb\t']
+        rand = random.Random(42)
+        chars = u'ab \t\n\r\x0b\x1c\x85\xa0\u3000\u2029\ufffe\x7f'
+        values.extend(u''.join(rand.choice(chars) for idx in xrange(8))
+                      for idx in xrange(500))
+        for value in values:
+            expected = self._reference(value)
+            self.assertEqual(expected, self.writer._normalize_text(value),
+                             repr(value))
+            # memoized
+            self.assertEqual(expected, self.writer._normalize_text(value),
+                             repr(value))
+
+
+class OpenpyxlWorksheetWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+        self.env.config.set('exceldownload', 'format', 'xlsx')
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _write_sheet(self, rows, hints=None):
+        book = get_workbook_writer(self.env, MockRequest(self.env))
+        writer = book.create_sheet('Sheet')
+        if hints:
+            writer.set_col_width_hints(hints)
+        for row in rows:
+            writer.write_row([(value, '*', None, None) for value in row])
+        writer.set_col_widths()
+        return self._load(book.dumps())
+
+    def _load(self, content):
+        from openpyxl import load_workbook
+        return load_workbook(StringIO(content))['Sheet']
+
+    def _rows(self):
+        return [[u'a' * 10, u'b']] * 5 + [[u'c' * 40, u'd' * 20]]
+
+    def test_col_widths_exact(self):
+        sheet = self._write_sheet(self._rows())
+        self.assertEqual(41, sheet.column_dimensions['A'].width)
+        self.assertEqual(21, sheet.column_dimensions['B'].width)
+        self.assertEqual(6, sheet.max_row)
+
+    def test_col_widths_sampled(self):
+        self.env.config.set('exceldownload', 'col_width_sample_rows', '3')
+        sheet = self._write_sheet(self._rows(), hints={1: 30})
+        self.assertEqual(11, sheet.column_dimensions['A'].width)
+        self.assertEqual(31, sheet.column_dimensions['B'].width)
+        self.assertEqual(6, sheet.max_row)
+        self.assertEqual(u'c' * 40, sheet.cell(row=6, column=1).value)
+
+    def test_store_only(self):
+        self.env.config.set('exceldownload', 'xlsx_compression_level', '0')
+        book = get_workbook_writer(self.env, MockRequest(self.env))
+        writer = book.create_sheet('Sheet')
+        writer.write_row([(u'value', '*', None, None)])
+        writer.set_col_widths()
+        content = book.dumps()
+        archive = zipfile.ZipFile(StringIO(content))
+        self.assertEqual(set([zipfile.ZIP_STORED]),
+                         set(i.compress_type for i in archive.infolist()))
+        self.assertEqual(u'value', self._load(content)['A1'].value)
+
+    def test_row_buffer_spill(self):
+        self.env.path = tempfile.mkdtemp()
+        try:
+            values = []
+            for size in ('0', '2048'):
+                self.env.config.set('exceldownload', 'xlsx_row_buffer_size',
+                                    size)
+                book = get_workbook_writer(self.env, MockRequest(self.env))
+                writer = book.create_sheet('Sheet')
+                for idx in xrange(100):
+                    link = Hyperlink('http://localhost/ticket/%d' % idx,
+                                     '#%d' % idx)
+                    writer.write_row([
+                        (link, 'id', None, None),
+                        (u'Value \u3042 %d' % idx, '*', None, None),
+                        (idx * 1.5, '*', None, None),
+                        (datetime(2017, 1, 1, idx % 24, tzinfo=utc),
+                         '[datetime]', None, None)])
+                    writer.write_row([])
+                self.assertEqual(size != '0', writer._rows._file is not None)
+                writer.set_col_widths()
+                sheet = self._load(book.dumps())
+                values.append([[cell.value for cell in row]
+                               for row in sheet.iter_rows()])
+            self.assertEqual(values[0], values[1])
+            self.assertEqual(199, len(values[0]))  # without the last empty row
+            self.assertEqual([], os.listdir(os.path.join(
+                self.env.path, 'files', 'exceldownload', 'tmp')))
+        finally:
+            shutil.rmtree(self.env.path)
+
+
+class RowBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(path=tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.env.path)
+
+    def _rows(self):
+        rows = []
+        for idx in xrange(50):
+            rows.append(([idx, u'Value %d' % idx, None][:idx % 4],
+                         ['id', '*', 'status:change'][:idx % 4]))
+            if idx % 10 == 0:
+                rows.append(([u'x'] * 5, ['*'] * 5))
+        return rows
+
+    def _assert_rows(self, max_size, spilled):
+        buffer = _RowBuffer(self.env, max_size)
+        rows = self._rows()
+        for values, styles in rows:
+            buffer.append(values, styles)
+        self.assertEqual(len(rows), len(buffer))
+        self.assertEqual(spilled, buffer._file is not None)
+        self.assertEqual([(tuple(values), styles) for values, styles in rows],
+                         [(tuple(values), styles)
+                          for values, styles in buffer])
+        buffer.close()
+        self.assertEqual([], list(buffer))
+
+    def test_memory(self):
+        self._assert_rows(0, False)
+
+    def test_spill(self):
+        self._assert_rows(256, True)
+
+
+class SpreadsheetMLWorksheetWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+        self.env.config.set('exceldownload', 'format', 'xlsx-native')
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def test_values(self):
+        from openpyxl import load_workbook
+        book = get_workbook_writer(self.env, MockRequest(self.env))
+        writer = book.create_sheet(u'Sheet <1>')
+        writer.write_row([(u'Title & more', 'header', -1, -1)])
+        writer.write_row([(u'a\x01b  \nc', '*', None, None),
+                          (42, 'id', None, None),
+                          (1.5, 'unknown', None, None),
+                          (True, '*:change', None, None),
+                          (datetime(2016, 12, 31, 13, 45, 59, 0, utc),
+                           '[datetime]', None, None)])
+        writer.set_col_widths()
+        book.create_sheet(u'Empty')
+        sheets = load_workbook(StringIO(book.dumps()))
+        self.assertEqual([u'Sheet <1>', u'Empty'], sheets.sheetnames)
+        sheet = sheets[u'Sheet <1>']
+        self.assertEqual(u'Title & more', sheet['A1'].value)
+        self.assertEqual(u'a\ufffdb\nc', sheet['A2'].value)
+        self.assertEqual(42, sheet['B2'].value)
+        self.assertEqual('"#"0', sheet['B2'].number_format)
+        self.assertEqual(1.5, sheet['C2'].value)
+        self.assertEqual(True, sheet['D2'].value)
+        self.assertEqual(datetime(2016, 12, 31, 13, 45, 59),
+                         sheet['E2'].value)
+        self.assertEqual(4, sheet.column_dimensions['A'].width)
+        self.assertEqual(None, sheets[u'Empty']['A1'].value)
+
+    def test_shared_strings(self):
+        from openpyxl import load_workbook
+        book = get_workbook_writer(self.env, MockRequest(self.env))
+        writer = book.create_sheet(u'Sheet')
+        long_text = u'<long> ' * 20
+        for idx in xrange(3):
+            writer.write_row([(u'new & <open>', 'status', None, None),
+                              (u'joe', 'owner', None, None),
+                              (long_text, 'description', None, None)])
+        content = book.dumps()
+        archive = zipfile.ZipFile(StringIO(content))
+        sst = archive.read('xl/sharedStrings.xml')
+        self.assertIn('count="6" uniqueCount="2"', sst)
+        self.assertEqual(1, sst.count('new &amp; &lt;open&gt;'))
+        self.assertIn('t="inlineStr"',
+                      archive.read('xl/worksheets/sheet1.xml'))
+        sheet = load_workbook(StringIO(content))[u'Sheet']
+        self.assertEqual(u'new & <open>', sheet['A3'].value)
+        self.assertEqual(u'joe', sheet['B3'].value)
+        self.assertEqual(long_text.rstrip(), sheet['C3'].value)
+
+    def test_compression_level(self):
+        def dump():
+            book = get_workbook_writer(self.env, MockRequest(self.env))
+            writer = book.create_sheet(u'Sheet')
+            for idx in xrange(100):
+                writer.write_row([(u'Value %d' % idx, '*', None, None)])
+            return zipfile.ZipFile(StringIO(book.dumps()))
+
+        self.assertEqual(set([zipfile.ZIP_DEFLATED]),
+                         set(i.compress_type for i in dump().infolist()))
+        self.env.config.set('exceldownload', 'xlsx_compression_level', '0')
+        archive = dump()
+        self.assertEqual(set([zipfile.ZIP_STORED]),
+                         set(i.compress_type for i in archive.infolist()))
+        self.assertIn('Value 99', archive.read('xl/sharedStrings.xml'))
+        self.env.config.set('exceldownload', 'xlsx_compression_level', '1')
+        archive = dump()
+        self.assertEqual(set([zipfile.ZIP_DEFLATED]),
+                         set(i.compress_type for i in archive.infolist()))
+        self.assertIn('Value 99', archive.read('xl/sharedStrings.xml'))
+
+    def test_iterdump(self):
+        from openpyxl import load_workbook
+        book = get_workbook_writer(self.env, MockRequest(self.env))
+        book.create_sheet(u'Sheet').write_row([(u'Value', '*', None, None)])
+        writer = book.create_sheet(u'Large')
+        for idx in xrange(20000):
+            writer.write_row([(u'Value %d' % idx, '*', None, None),
+                              (u'%08x' % (idx * 2654435761), '*', None, None)])
+        size, content = book.iterdump()
+        self.assertEqual(None, size)
+        chunks = []
+        for chunk in content:
+            chunks.append(chunk)
+            if len(chunks) == 1:
+                # the first entries are sent before the large sheet
+                self.assertFalse(writer.sheet.closed)
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(writer.sheet.closed)
+        content = ''.join(chunks)
+        archive = zipfile.ZipFile(StringIO(content))
+        self.assertEqual(None, archive.testzip())
+        self.assertEqual(set([0x08]),
+                         set(i.flag_bits for i in archive.infolist()))
+        sheets = load_workbook(StringIO(content))
+        self.assertEqual([u'Sheet', u'Large'], sheets.sheetnames)
+        self.assertEqual(u'Value 19999', sheets[u'Large']['A20000'].value)
+
+    def test_sheet_threads(self):
+        from openpyxl import load_workbook
+        self.env.config.set('exceldownload', 'sheet_threads', '2')
+        book = get_workbook_writer(self.env, MockRequest(self.env))
+        book.parallel_min_size = 0
+        deflate_sheets = book._deflate_sheets
+        parts = []
+        book._deflate_sheets = lambda level: \
+                               parts.append(deflate_sheets(level)) or parts[0]
+        for idx in xrange(3):
+            writer = book.create_sheet(u'Sheet %d' % idx)
+            for row in xrange(1000):
+                writer.write_row([(u'Value %d' % row, '*', None, None),
+                                  (row * idx, 'id', None, None)])
+            writer.set_col_widths()
+        sheets = load_workbook(StringIO(book.dumps()))
+        self.assertEqual([u'Sheet 0', u'Sheet 1', u'Sheet 2'],
+                         sheets.sheetnames)
+        for idx in xrange(3):
+            sheet = sheets[u'Sheet %d' % idx]
+            self.assertEqual(1000, sheet.max_row)
+            self.assertEqual(u'Value 999', sheet['A1000'].value)
+            self.assertEqual(999 * idx, sheet['B1000'].value)
+        self.assertEqual(3, len(parts[0]))
+
+
+class HyperlinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _get_book(self, format):
+        self.env.config.set('exceldownload', 'format', format)
+        return get_workbook_writer(self.env, MockRequest(self.env))
+
+    def test_formula(self):
+        link = Hyperlink('http://localhost/ticket/1', u'"#1"')
+        self.assertEqual(u'HYPERLINK("http://localhost/ticket/1","""#1""")',
+                         link.formula())
+
+    def test_xlwt_tokens(self):
+        from xlwt import Formula
+        book = self._get_book('xls')
+        for url, label in (('http://localhost/ticket/1', '#1'),
+                           (u'http://localhost/wiki/\u00e9t\u00e9',
+                            u'"\u3042"'),
+                           ('', '')):
+            link = Hyperlink(url, label)
+            formula = book.hyperlink_formula(link)
+            self.assertEqual(Formula(link.formula()).rpn(), formula.rpn())
+            self.assertEqual(link.formula(), formula.text())
+        link = Hyperlink('http://localhost/' + 'x' * 256, '#1')
+        self.assertEqual(u'#1', book.hyperlink_formula(link))
+
+    def test_xlwt_sheet(self):
+        book = self._get_book('xls')
+        writer = book.create_sheet('Sheet')
+        writer.write_row([(Hyperlink('http://localhost/ticket/1', '#1'),
+                           'id', None, None)])
+        writer.set_col_widths()
+        self.assertTrue(book.dumps())
+
+    def _assert_xlsx(self, format):
+        from openpyxl import load_workbook
+        book = self._get_book(format)
+        writer = book.create_sheet('Sheet')
+        writer.write_row([(Hyperlink('http://localhost/ticket/1', '#1'),
+                           'id', 2, 1),
+                          (Hyperlink('http://localhost/?q=<&>', '"a"'),
+                           '*', None, None)])
+        writer.set_col_widths()
+        sheet = load_workbook(StringIO(book.dumps()))['Sheet']
+        self.assertEqual('=HYPERLINK("http://localhost/ticket/1","#1")',
+                         sheet['A1'].value)
+        self.assertEqual('=HYPERLINK("http://localhost/?q=<&>","""a""")',
+                         sheet['B1'].value)
+
+    def test_openpyxl(self):
+        self._assert_xlsx('xlsx')
+
+    def test_spreadsheetml(self):
+        self._assert_xlsx('xlsx-native')
+
+
+class ExportCancellerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _checkpoints(self, canceller):
+        for idx in xrange(canceller.checkpoint_rows - 1):
+            canceller.checkpoint()
+
+    def test_time_budget(self):
+        req = MockRequest(self.env)
+        canceller = ExportCanceller(self.env, req)
+        time.sleep(0.01)
+        canceller.check()  # no budget by default
+
+        self.env.config.set('exceldownload', 'export_time_budget', '0.005')
+        canceller = ExportCanceller(self.env, req)
+        canceller.check()
+        time.sleep(0.01)
+        self._checkpoints(canceller)
+        self.assertRaises(ExportAborted, canceller.checkpoint)
+        self.assertRaises(ExportAborted, canceller.check)
+
+        req.environ['tracexceldownload.background'] = True
+        canceller = ExportCanceller(self.env, req)
+        time.sleep(0.01)
+        canceller.check()
+
+    def test_disconnect(self):
+        server, client = socket.socketpair()
+        try:
+            req = MockRequest(self.env)
+            req.environ['gunicorn.socket'] = server
+            canceller = ExportCanceller(self.env, req)
+            canceller.check()
+            client.sendall('GET / HTTP/1.1\r\n')  # a pipelined request
+            canceller.check()
+            client.close()
+            self._checkpoints(canceller)
+            server.recv(1024)
+            self.assertRaises(RequestDone, canceller.checkpoint)
+        finally:
+            server.close()
+            client.close()
+
+
+class LazyBackendsTestCase(unittest.TestCase):
+
+    def test_plugin_import(self):
+        from tracexceldownload.tests.benchmark import measure_import
+        self.assertEqual([], measure_import()['backends'])
+
+    def test_format(self):
+        env = EnvironmentStub()
+        try:
+            for format, ext in (('(auto)', 'xlsx'), ('xlsx', 'xlsx'),
+                                ('xls', 'xls'), ('xlsx-native', 'xlsx')):
+                env.config.set('exceldownload', 'format', format)
+                self.assertEqual(ext, get_excel_format(env))
+        finally:
+            env.reset_db()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TextMetricsTestCase))
+    suite.addTest(unittest.makeSuite(NormalizeTextTestCase))
+    suite.addTest(unittest.makeSuite(OpenpyxlWorksheetWriterTestCase))
+    suite.addTest(unittest.makeSuite(RowBufferTestCase))
+    suite.addTest(unittest.makeSuite(SpreadsheetMLWorksheetWriterTestCase))
+    suite.addTest(unittest.makeSuite(HyperlinkTestCase))
+    suite.addTest(unittest.makeSuite(ExportCancellerTestCase))
+    suite.addTest(unittest.makeSuite(LazyBackendsTestCase))
+    return suite
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of Excel exports on synthetic environments.
+
+Run ``python -m tracexceldownload.tests.benchmark --help`` for the options.
+The results are written as JSON and can be compared with the results of
+another commit using ``--compare``.
+"""
+
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from trac import __version__ as trac_version
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.query import Query
+from trac.ticket.report import ReportModule
+from trac.util.datefmt import to_utimestamp, utc
+from trac.web.api import RequestDone
+
+from tracexceldownload.ticket import ExcelReportModule, ExcelTicketModule
+
+
+_sizes = {'small': 1000, 'medium': 10000, 'large': 100000}
+_formats = ('xls', 'xlsx', 'xlsx-native')
+_cases = ('query', 'history', 'report')
+_plugins = ('api', 'cache', 'delta', 'jobs', 'ticket', 'translation')
+_backends = ('openpyxl', 'xlwt')
+
+_words = ['trac', 'excel', 'export', 'ticket', 'query', 'report', 'sheet',
+          'column', 'width', 'value', 'change', 'history', 'milestone',
+          'component', 'owner', 'status', 'defect', 'enhancement', 'task']
+_cjk_words = [u'チケット', u'変更履歴',
+              u'マイルストーン', u'担当',
+              u'表計算', u'한국어', u'中文']
+_statuses = ['new', 'assigned', 'accepted', 'reopened', 'closed']
+_options = ['alpha', 'beta', 'gamma', 'delta', 'epsilon']
+
+
+class Generator(object):
+    """Fill an environment with random but reproducible tickets."""
+
+    def __init__(self, env, seed=0, custom_fields=10, changes=5,
+                 cjk_ratio=0.2, description_paragraphs=3):
+        self.env = env
+        self.random = random.Random(seed)
+        self.custom_fields = custom_fields
+        self.changes = changes
+        self.cjk_ratio = cjk_ratio
+        self.description_paragraphs = description_paragraphs
+        self.start = datetime(2010, 1, 1, tzinfo=utc)
+
+    def configure(self):
+        config = self.env.config
+        types = ('text', 'select', 'checkbox', 'textarea', 'radio')
+        for idx in xrange(self.custom_fields):
+            name = 'custom%02d' % idx
+            type_ = types[idx % len(types)]
+            config.set('ticket-custom', name, type_)
+            if type_ in ('select', 'radio'):
+                config.set('ticket-custom', name + '.options',
+                           '|'.join(_options))
+        self.env.config.set('ticket', 'restrict_owner', 'false')
+        self.custom_field_types = [('custom%02d' % idx,
+                                    types[idx % len(types)])
+                                   for idx in xrange(self.custom_fields)]
+
+    def populate(self, num):
+        env = self.env
+        self.configure()
+        @env.with_transaction()
+        def fn(db):
+            cursor = db.cursor()
+            for start in xrange(1, num + 1, 1000):
+                tickets = []
+                customs = []
+                changes = []
+                for id in xrange(start, min(start + 1000, num + 1)):
+                    self._generate(id, tickets, customs, changes)
+                cursor.executemany("""
+                    INSERT INTO ticket (id,type,time,changetime,component,
+                                        severity,priority,owner,reporter,cc,
+                                        version,milestone,status,resolution,
+                                        summary,description,keywords)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
+                            %s)""", tickets)
+                cursor.executemany("""
+                    INSERT INTO ticket_custom (ticket,name,value)
+                    VALUES (%s,%s,%s)""", customs)
+                cursor.executemany("""
+                    INSERT INTO ticket_change (ticket,time,author,field,
+                                               oldvalue,newvalue)
+                    VALUES (%s,%s,%s,%s,%s,%s)""", changes)
+
+    def _generate(self, id, tickets, customs, changes):
+        rand = self.random
+        created = self.start + timedelta(minutes=id * 7)
+        values = {
+            'type': rand.choice(['defect', 'enhancement', 'task']),
+            'component': 'component%d' % rand.randint(1, 2),
+            'priority': rand.choice(['blocker', 'critical', 'major',
+                                     'minor', 'trivial']),
+            'owner': 'user%d' % rand.randint(1, 50),
+            'reporter': 'user%d' % rand.randint(1, 50),
+            'milestone': 'milestone%d' % rand.randint(1, 4),
+            'version': rand.choice(['', '1.0', '2.0']),
+            'status': 'new',
+            'resolution': '',
+            'summary': self._text(rand.randint(4, 12)),
+            'description': '\n\n'.join(
+                self._text(rand.randint(20, 80))
+                for idx in xrange(self.description_paragraphs)),
+            'keywords': ' '.join(rand.sample(_words, 3)),
+        }
+        for name, type_ in self.custom_field_types:
+            values[name] = self._custom_value(type_)
+
+        when = created
+        for cnum in xrange(1, rand.randint(0, self.changes * 2) + 1):
+            when += timedelta(hours=rand.randint(1, 48))
+            ts = to_utimestamp(when)
+            author = 'user%d' % rand.randint(1, 50)
+            changes.append((id, ts, author, 'comment', str(cnum),
+                            self._text(rand.randint(5, 40))))
+            fields = rand.sample(['status', 'owner', 'priority'] +
+                                 [name for name, type_
+                                       in self.custom_field_types], 2)
+            for name in fields:
+                old = values[name]
+                if name == 'status':
+                    new = rand.choice(_statuses)
+                elif name == 'owner':
+                    new = 'user%d' % rand.randint(1, 50)
+                elif name == 'priority':
+                    new = rand.choice(['major', 'minor'])
+                else:
+                    new = self._custom_value(
+                        dict(self.custom_field_types)[name])
+                if old != new:
+                    changes.append((id, ts, author, name, old, new))
+                    values[name] = new
+        if values['status'] == 'closed':
+            values['resolution'] = 'fixed'
+
+        tickets.append((id, values['type'], to_utimestamp(created),
+                        to_utimestamp(when), values['component'], None,
+                        values['priority'], values['owner'],
+                        values['reporter'], '', values['version'],
+                        values['milestone'], values['status'],
+                        values['resolution'], values['summary'],
+                        values['description'], values['keywords']))
+        customs.extend((id, name, values[name])
+                       for name, type_ in self.custom_field_types)
+
+    def _text(self, count):
+        rand = self.random
+        words = []
+        for idx in xrange(count):
+            if rand.random() < self.cjk_ratio:
+                words.append(rand.choice(_cjk_words))
+            else:
+                words.append(rand.choice(_words))
+        return u' '.join(words)
+
+    def _custom_value(self, type_):
+        rand = self.random
+        if type_ in ('select', 'radio'):
+            return rand.choice(_options)
+        if type_ == 'checkbox':
+            return str(rand.randint(0, 1))
+        if type_ == 'textarea':
+            return self._text(rand.randint(10, 60))
+        return self._text(rand.randint(1, 4))
+
+
+def _query_string(env):
+    columns = ['id', 'summary', 'status', 'type', 'priority', 'component',
+               'owner', 'milestone', 'time', 'changetime']
+    columns.extend(name for name, value in env.config.options('ticket-custom')
+                        if '.' not in name)
+    return 'max=0&order=id&' + '&'.join('col=%s' % col for col in columns)
+
+
+def _consume(content):
+    if isinstance(content, basestring):
+        return len(content)
+    return sum(len(chunk) for chunk in content)
+
+
+def run_case(env, case, format):
+    """Run one export and return the size of the generated file."""
+    env.config.set('exceldownload', 'format', format)
+    req = MockRequest(env)
+    if case in ('query', 'history'):
+        mod = ExcelTicketModule(env)
+        query = Query.from_string(env, _query_string(env))
+        key = ('excel', 'excel-history')[case == 'history']
+        content, mimetype = mod.convert_content(req, None, query, key)
+        return _consume(content)
+    # the export streamed from the report SQL by the request filter
+    req = MockRequest(env, path_info='/report/1',
+                      args={'id': '1', 'format': 'xls', 'max': '0'})
+    try:
+        ExcelReportModule(env).pre_process_request(req, ReportModule(env))
+    except RequestDone:
+        return len(req.response_sent.getvalue())
+    raise RuntimeError('The report was not streamed from its SQL')
+
+
+def _maxrss():
+    # kilobytes on Linux, bytes on Mac OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return maxrss
+
+
+def measure(env, case, format):
+    """Run `case` in a forked process when possible, so that the peak
+    memory of each case is measured separately.
+    """
+    def run():
+        rss = _maxrss()
+        start = time.time()
+        size = run_case(env, case, format)
+        return {'seconds': time.time() - start, 'size': size,
+                'peak_rss_kb': _maxrss(), 'rss_before_kb': rss}
+
+    if not hasattr(os, 'fork'):
+        return run()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            result = run()
+        except Exception, e:
+            result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+        os.write(wfd, json.dumps(result))
+        os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd, 'rb') as f:
+        result = json.loads(f.read() or '{}')
+    os.waitpid(pid, 0)
+    return result
+
+
+_import_script = """\
+import json, sys, time
+start = time.time()
+for name in sys.argv[1:]:
+    __import__(name)
+seconds = time.time() - start
+print json.dumps({'seconds': seconds,
+                  'backends': sorted(name for name in sys.modules
+                                          if name.split('.')[0] in %r)})
+""" % (_backends,)
+
+
+def measure_import():
+    """Import the plugin modules in a new process like a starting Trac
+    worker and return the seconds and the backend modules it imported.
+    """
+    args = [sys.executable, '-c', _import_script]
+    args.extend('tracexceldownload.' + name for name in _plugins)
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise RuntimeError('Importing the plugin failed (%d)'
+                           % proc.returncode)
+    return json.loads(output)
+
+
+def compare(baseline, results, out):
+    """Print the ratio of the timings of `results` to `baseline`."""
+    def index(data):
+        return dict(((r['case'], r['format']), r) for r in data['results'])
+
+    base = index(baseline)
+    for key, result in sorted(index(results).iteritems()):
+        if key not in base or 'seconds' not in result or \
+                'seconds' not in base[key]:
+            continue
+        old = min(base[key]['seconds'])
+        new = min(result['seconds'])
+        out.write('%-8s %-12s %9.3fs %9.3fs %6.2fx\n'
+                  % (key[0], key[1], old, new, new / old if old else 0))
+
+
+def _version(name):
+    try:
+        module = __import__(name)
+    except ImportError:
+        return None
+    return getattr(module, '__version__', None) or \
+           getattr(module, '__VERSION__', None)
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--size', choices=sorted(_sizes), default='small',
+                      help='number of tickets: small (1k), medium (10k) or '
+                           'large (100k) [default: %default]')
+    parser.add_option('--tickets', type='int',
+                      help='number of tickets, overrides --size')
+    parser.add_option('--custom-fields', type='int', default=10,
+                      help='number of custom fields [default: %default]')
+    parser.add_option('--changes', type='int', default=5,
+                      help='average number of changes per ticket '
+                           '[default: %default]')
+    parser.add_option('--cjk-ratio', type='float', default=0.2,
+                      help='ratio of CJK words in texts [default: %default]')
+    parser.add_option('--paragraphs', type='int', default=3,
+                      help='paragraphs of the descriptions '
+                           '[default: %default]')
+    parser.add_option('--format', action='append', choices=_formats,
+                      help='backend to run, may be repeated [default: all]')
+    parser.add_option('--case', action='append', choices=_cases,
+                      help='export to run, may be repeated [default: all]')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of each case [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed [default: %default]')
+    parser.add_option('--output', '-o', help='write the results to a file')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the timings with a previous result')
+    options, args = parser.parse_args(args)
+
+    num = options.tickets or _sizes[options.size]
+    path = tempfile.mkdtemp(prefix='tracexceldownload-bench-')
+    try:
+        env = EnvironmentStub(default_data=True, path=path,
+                              enable=['trac.*', 'tracexceldownload.*'])
+        generator = Generator(env, seed=options.seed,
+                              custom_fields=options.custom_fields,
+                              changes=options.changes,
+                              cjk_ratio=options.cjk_ratio,
+                              description_paragraphs=options.paragraphs)
+        start = time.time()
+        generator.populate(num)
+        sys.stderr.write('Generated %d tickets in %.1f seconds\n'
+                         % (num, time.time() - start))
+
+        imports = measure_import()
+        sys.stderr.write('Imported the plugin in %.3f seconds\n'
+                         % imports['seconds'])
+
+        results = []
+        for case in options.case or _cases:
+            for format in options.format or _formats:
+                runs = [measure(env, case, format)
+                        for idx in xrange(options.repeat)]
+                result = {'case': case, 'format': format}
+                errors = [run['error'] for run in runs if 'error' in run]
+                if errors:
+                    result['error'] = errors[0]
+                else:
+                    result['seconds'] = [run['seconds'] for run in runs]
+                    result['size'] = runs[0]['size']
+                    result['peak_rss_kb'] = max(run['peak_rss_kb']
+                                                for run in runs)
+                    result['rss_before_kb'] = min(run['rss_before_kb']
+                                                  for run in runs)
+                sys.stderr.write('%-8s %-12s %s\n'
+                                 % (case, format,
+                                    result.get('error') or
+                                    '%.3fs' % min(result['seconds'])))
+                results.append(result)
+        env.reset_db()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    data = {
+        'parameters': {'tickets': num,
+                       'custom_fields': options.custom_fields,
+                       'changes': options.changes,
+                       'cjk_ratio': options.cjk_ratio,
+                       'paragraphs': options.paragraphs,
+                       'repeat': options.repeat, 'seed': options.seed},
+        'platform': {'python': platform.python_version(),
+                     'trac': trac_version, 'system': platform.platform(),
+                     'openpyxl': _version('openpyxl'),
+                     'xlwt': _version('xlwt')},
+        'import': imports,
+        'results': results,
+    }
+    output = json.dumps(data, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), data, sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
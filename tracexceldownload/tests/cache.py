@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Priority, Ticket
+from trac.ticket.query import Query
+from trac.ticket.report import ReportModule
+from trac.web.api import RequestDone
+
+from tracexceldownload.api import get_work_dir
+from tracexceldownload.cache import ExcelDownloadCache
+from tracexceldownload.ticket import ExcelReportModule, ExcelTicketModule
+
+
+class ExcelDownloadCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   path=tempfile.mkdtemp())
+        self.env.config.set('exceldownload', 'format', 'xlsx-native')
+        self.env.config.set('exceldownload', 'cache_size', '1000000')
+        for idx in xrange(3):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'Summary %d' % idx
+            ticket['status'] = 'new'
+            ticket.insert()
+        self.cache = ExcelDownloadCache(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.env.path)
+
+    def _convert(self, query='status=new'):
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, query)
+        content, mimetype = mod.convert_content(req, None, query, 'excel')
+        return ''.join(content)
+
+    def _export_report(self, id):
+        req = MockRequest(self.env, path_info='/report/%d' % id,
+                          args={'id': str(id), 'format': 'xlsx'})
+        self.assertRaises(RequestDone, ExcelReportModule(self.env)
+                          .pre_process_request, req, ReportModule(self.env))
+        return req.response_sent.getvalue()
+
+    def _entries(self):
+        return os.listdir(get_work_dir(self.env, 'cache'))
+
+    def test_hit(self):
+        content = self._convert()
+        self.assertEqual((0, 1), (self.cache._hits, self.cache._misses))
+        self.assertEqual(1, len(self._entries()))
+        self.assertEqual(content, self._convert())
+        self.assertEqual((1, 1), (self.cache._hits, self.cache._misses))
+
+    def test_invalidated_by_ticket_change(self):
+        self._convert()
+        ticket = Ticket(self.env, 1)
+        ticket['summary'] = 'Changed'
+        ticket.save_changes('admin', 'comment')
+        self._convert()
+        self.assertEqual((0, 2), (self.cache._hits, self.cache._misses))
+
+    def test_invalidated_by_config_change(self):
+        self._convert()
+        self.env.config.set('exceldownload', 'xlsx_compression_level', '1')
+        self._convert()
+        self.env.config.set('trac', 'show_email_addresses', 'enabled')
+        self._convert()
+        self._convert()
+        self.assertEqual((1, 3), (self.cache._hits, self.cache._misses))
+
+    def test_evicted_while_stored(self):
+        def rename(src, dst):
+            os_rename(src, dst)
+            os.remove(dst)  # evicted by another process
+        os_rename = os.rename
+        os.rename = rename
+        try:
+            content = self._convert()
+        finally:
+            os.rename = os_rename
+        self.assertEqual('PK\x03\x04', content[:4])
+        self.assertEqual([], self._entries())
+
+    def test_evict_by_size(self):
+        content = self._convert()
+        self.env.config.set('exceldownload', 'cache_size',
+                            str(len(content) + 1))
+        self._convert('status=new&order=summary')
+        self.assertEqual(1, len(self._entries()))
+
+    def test_report_hit(self):
+        content = self._export_report(1)
+        self.assertEqual(1, len(self._entries()))
+        self.assertEqual(content, self._export_report(1))
+        self.assertEqual((1, 1), (self.cache._hits, self.cache._misses))
+
+    def test_report_invalidated_by_joined_table(self):
+        # {1} Active Tickets joins the enum table for the priorities
+        self._export_report(1)
+        priority = Priority(self.env, 'major')
+        priority.name = 'medium'
+        priority.update()
+        self._export_report(1)
+        self.assertEqual((0, 2), (self.cache._hits, self.cache._misses))
+
+    def test_report_untracked_table(self):
+        @self.env.with_transaction()
+        def fn(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO report (id,author,title,query,description)
+                VALUES (9,'admin','Attachments',
+                        'SELECT t.id AS ticket, a.filename
+                         FROM ticket t, attachment AS a
+                         WHERE a.type=''ticket'' AND a.id=t.id','')""")
+        self._export_report(9)
+        self._export_report(9)
+        self.assertEqual([], self._entries())
+        self.assertEqual((0, 0), (self.cache._hits, self.cache._misses))
+
+    def test_disabled(self):
+        self.env.config.set('exceldownload', 'cache_size', '0')
+        self._convert()
+        self._convert()
+        self.assertEqual((0, 0), (self.cache._hits, self.cache._misses))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ExcelDownloadCacheTestCase))
+    return suite
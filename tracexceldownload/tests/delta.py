@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import unittest
+import zipfile
+from cStringIO import StringIO
+from datetime import datetime
+
+from trac.core import TracError
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.ticket.query import Query
+from trac.util.datefmt import utc
+
+from tracexceldownload.delta import ExcelDeltaTokens
+from tracexceldownload.ticket import ExcelTicketModule
+
+
+class ExcelDeltaExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   path=tempfile.mkdtemp())
+        self.env.config.set('exceldownload', 'format', 'xlsx-native')
+        for idx in xrange(5):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'Summary %d' % idx
+            ticket['status'] = 'new'
+            ticket.insert(when=datetime(2017, 1, 1 + idx, tzinfo=utc))
+        self.tokens = ExcelDeltaTokens(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.env.path)
+
+    def _convert(self, since, authname='anonymous'):
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env, authname=authname,
+                          args={'since': since})
+        query = Query.from_string(self.env, 'status=new')
+        content, mimetype = mod.convert_content(req, None, query, 'excel')
+        zf = zipfile.ZipFile(StringIO(''.join(content)))
+        sheet = zf.read('xl/worksheets/sheet1.xml')
+        tkt_ids = [id for id in xrange(1, 6)
+                      if '/ticket/%d&quot;' % id in sheet]
+        return dict(req._outheaders).get('X-Excel-Delta-Token'), tkt_ids
+
+    def test_full_export(self):
+        token, tkt_ids = self._convert('')
+        self.assertEqual([1, 2, 3, 4, 5], tkt_ids)
+        self.assertEqual([1, 2, 3, 4, 5], self.tokens._read(token)['ids'])
+
+    def test_since_date(self):
+        token, tkt_ids = self._convert('2017-01-04T00:00:00Z')
+        self.assertEqual(None, token)
+        self.assertEqual([4, 5], tkt_ids)
+
+    def test_since_token(self):
+        token, tkt_ids = self._convert('')
+        ticket = Ticket(self.env, 2)
+        ticket['summary'] = 'Changed'
+        ticket.save_changes('joe', 'changed')
+        ticket = Ticket(self.env, 4)
+        ticket['status'] = 'closed'
+        ticket.save_changes('joe', 'closed')
+        Ticket(self.env, 5).delete()
+
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=new')
+        since, previous = self.tokens.parse_since(req, token,
+                                                  query.to_string())
+        self.assertEqual([1, 2, 3, 4, 5], sorted(previous))
+        self.assertEqual({4: 'No longer matching', 5: 'Deleted'},
+                         mod._get_removed_tickets(req, since, previous,
+                                                  set([2]),
+                                                  self.env.get_read_db()))
+
+        token, tkt_ids = self._convert(token)
+        self.assertEqual([2], tkt_ids)
+        self.assertEqual([1, 2, 3], self.tokens._read(token)['ids'])
+
+        token, tkt_ids = self._convert(token)
+        self.assertEqual([], tkt_ids)
+        self.assertEqual([1, 2, 3], self.tokens._read(token)['ids'])
+
+    def test_invalid_token(self):
+        token, tkt_ids = self._convert('')
+        self.assertRaises(TracError, self._convert, token, authname='joe')
+        self.assertRaises(TracError, self._convert, '0' * 32)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ExcelDeltaExportTestCase))
+    return suite
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from trac.core import TracError
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+from trac.ticket.query import Query
+from trac.ticket.report import ReportModule
+from trac.web.api import HTTPNotFound, RequestDone
+
+from tracexceldownload.delta import ExcelDeltaTokens
+from tracexceldownload.jobs import ExcelExportJobModule, _JobRequest
+from tracexceldownload.ticket import ExcelReportModule, ExcelTicketModule
+
+
+class ExcelExportJobModuleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   path=tempfile.mkdtemp())
+        self.env.config.set('exceldownload', 'format', 'xlsx-native')
+        self.env.config.set('exceldownload', 'background_workers', '1')
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'Summary'
+        ticket['status'] = 'new'
+        ticket.insert()
+        self.mod = ExcelExportJobModule(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.env.path)
+
+    def _request(self, job_id, **kwargs):
+        req = MockRequest(self.env, path_info='/exceldownload/job/' + job_id,
+                          **kwargs)
+        self.assertTrue(self.mod.match_request(req))
+        self.assertRaises(RequestDone, self.mod.process_request, req)
+        return req
+
+    def _wait(self, req):
+        job_id = req.headers_sent['Location'].rsplit('/', 1)[1]
+        for idx in xrange(100):
+            req = self._request(job_id, authname=req.authname,
+                                args={'format': 'json'})
+            status = json.loads(req.response_sent.getvalue())['status']
+            if status == 'done':
+                break
+            time.sleep(0.05)
+        self.assertEqual('done', status)
+        return job_id
+
+    def test_query(self):
+        req = MockRequest(self.env, args={'background': '1'})
+        query = Query.from_string(self.env, 'status=new')
+        self.assertRaises(RequestDone, ExcelTicketModule(self.env)
+                          .convert_content, req, None, query, 'excel')
+        self.assertNotIn('tracexceldownload.background', req.environ)
+        job_id = self._wait(req)
+
+        req = self._request(job_id)
+        self.assertEqual(['200 Ok'], req.status_sent)
+        self.assertEqual('PK\x03\x04', ''.join(req._response)[:4])
+        self.assertIn('query.xlsx', req.headers_sent['Content-Disposition'])
+
+        req = MockRequest(self.env, authname='someone',
+                          path_info='/exceldownload/job/' + job_id)
+        self.assertTrue(self.mod.match_request(req))
+        self.assertRaises(HTTPNotFound, self.mod.process_request, req)
+
+    def test_file_headers(self):
+        self.env.config.set('exceldownload', 'timing_header', 'enabled')
+        PermissionSystem(self.env).grant_permission('admin', 'TRAC_ADMIN')
+        req = MockRequest(self.env, authname='admin',
+                          args={'background': '1', 'since': ''})
+        query = Query.from_string(self.env, 'status=new')
+        self.assertRaises(RequestDone, ExcelTicketModule(self.env)
+                          .convert_content, req, None, query, 'excel')
+        job_id = self._wait(req)
+
+        req = self._request(job_id, authname='admin')
+        token = req.headers_sent['X-Excel-Delta-Token']
+        self.assertEqual([1], ExcelDeltaTokens(self.env)._read(token)['ids'])
+        self.assertIn('total;dur=', req.headers_sent['Server-Timing'])
+
+    def test_report(self):
+        req = MockRequest(self.env, path_info='/report/1',
+                          args={'id': '1', 'format': 'xlsx',
+                                'background': '1'})
+        self.assertRaises(RequestDone, ExcelReportModule(self.env)
+                          .pre_process_request, req, ReportModule(self.env))
+        job_id = self._wait(req)
+        req = self._request(job_id)
+        self.assertEqual('PK\x03\x04', ''.join(req._response)[:4])
+        self.assertIn('report_1.xlsx',
+                      req.headers_sent['Content-Disposition'])
+
+    def test_job_request(self):
+        req = MockRequest(self.env, authname='joe',
+                          args={'background': '1', 'since': ''})
+        job_req = _JobRequest(req)
+        self.assertEqual('joe', job_req.authname)
+        self.assertEqual(req.args, job_req.args)
+        self.assertTrue(job_req.environ['tracexceldownload.background'])
+        for name in ('send_header', 'end_headers', 'write', 'redirect'):
+            self.assertRaises(RuntimeError, getattr(job_req, name), 'x')
+
+    def test_stale(self):
+        job_id = 'deadbeef' * 4
+        self.mod._write_meta(job_id, {'owner': 'anonymous',
+                                      'filename': 'query.xlsx'})
+        path = self.mod._get_path(job_id, 'json')
+        req = self._request(job_id, args={'format': 'json'})
+        self.assertEqual({'status': 'pending'},
+                         json.loads(req.response_sent.getvalue()))
+
+        mtime = time.time() - self.mod._job_stale_age - 1
+        os.utime(path, (mtime, mtime))
+        req = MockRequest(self.env, args={'format': 'json'},
+                          path_info='/exceldownload/job/' + job_id)
+        self.assertTrue(self.mod.match_request(req))
+        self.assertRaises(TracError, self.mod.process_request, req)
+
+        # the process owning the job keeps it alive
+        self.mod._jobs.add(job_id)
+        self.mod._touch_jobs()
+        self.assertLess(mtime, os.stat(path).st_mtime)
+        self._request(job_id, args={'format': 'json'})
+
+    def test_disabled(self):
+        self.env.config.set('exceldownload', 'background_workers', '0')
+        req = MockRequest(self.env, args={'background': '1'})
+        query = Query.from_string(self.env, 'status=new')
+        content, mimetype = ExcelTicketModule(self.env) \
+                            .convert_content(req, None, query, 'excel')
+        self.assertEqual('PK\x03\x04', ''.join(content)[:4])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ExcelExportJobModuleTestCase))
+    return suite
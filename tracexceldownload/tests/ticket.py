@@ -1,16 +1,37 @@
 # -*- coding: utf-8 -*-
 
+from cStringIO import StringIO
 from datetime import datetime, timedelta
+from gzip import GzipFile
 import unittest
+import zipfile
 
+from trac.core import Component, implements
+from trac.mimeview.api import Context, Mimeview
+from trac.perm import IPermissionPolicy, PermissionSystem
 from trac.test import EnvironmentStub, MockRequest
 from trac.ticket.model import Ticket
-from trac.ticket.query import Query
+from trac.ticket.query import Query, QueryModule
 from trac.ticket.report import ReportModule
 from trac.util.datefmt import utc
 from trac.web.api import RequestDone
+from trac.web.chrome import Chrome
 
-from tracexceldownload.ticket import ExcelTicketModule, ExcelReportModule
+from tracexceldownload.api import ExportAborted, get_workbook_writer
+from tracexceldownload.ticket import (BulkFetchTicket, ExcelTicketModule,
+                                      ExcelReportModule, _AuthorFormatter,
+                                      _TicketHistory, _TicketIdFilter,
+                                      _get_db)
+
+
+class OddTicketsPermissionPolicy(Component):
+
+    implements(IPermissionPolicy)
+
+    def check_permission(self, action, username, resource, perm):
+        if action == 'TICKET_VIEW' and resource and \
+                resource.realm == 'ticket' and resource.id:
+            return resource.id % 2 == 0
 
 
 class AbstractExcelTicketTestCase(unittest.TestCase):
@@ -60,6 +81,7 @@ class AbstractExcelTicketTestCase(unittest.TestCase):
         ticket = Ticket(self.env, 11)
         content, mimetype = mod.convert_content(req, self._mimetype, ticket,
                                                 'excel-history')
+        content = ''.join(content)
         self.assertEqual(self._magic_number, content[:8])
         self.assertEqual(self._mimetype, mimetype)
 
@@ -69,10 +91,12 @@ class AbstractExcelTicketTestCase(unittest.TestCase):
         query = Query.from_string(self.env, 'status=!closed&max=9')
         content, mimetype = mod.convert_content(req, self._mimetype, query,
                                                 'excel')
+        content = ''.join(content)
         self.assertEqual(self._magic_number, content[:8])
         self.assertEqual(self._mimetype, mimetype)
         content, mimetype = mod.convert_content(req, self._mimetype, query,
                                                 'excel-history')
+        content = ''.join(content)
         self.assertEqual(self._magic_number, content[:8])
         self.assertEqual(self._mimetype, mimetype)
 
@@ -91,6 +115,353 @@ class AbstractExcelTicketTestCase(unittest.TestCase):
             content = req.response_sent.getvalue()
             self.assertEqual(self._magic_number, content[:8])
             self.assertEqual(self._mimetype, req.headers_sent['Content-Type'])
+            self._assert_content_length(req, content)
+
+    def _assert_content_length(self, req, content):
+        if self._format == 'xlsx-native':
+            # sent while the archive is written
+            self.assertNotIn('Content-Length', req.headers_sent)
+        else:
+            self.assertEqual(str(len(content)),
+                             req.headers_sent['Content-Length'])
+
+    def _export_report(self, id, stream):
+        mod = ExcelReportModule(self.env)
+        report_mod = ReportModule(self.env)
+        req = MockRequest(self.env, path_info='/report/%d' % id,
+                          args={'id': str(id), 'format': 'xls', 'max': '0'})
+        try:
+            if stream:
+                mod.pre_process_request(req, report_mod)
+            else:
+                template, data, content_type = \
+                    report_mod.process_request(req)
+                mod.post_process_request(req, template, data, content_type)
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content = req.response_sent.getvalue()
+        if content.startswith('PK'):
+            zf = zipfile.ZipFile(StringIO(content))
+            return [zf.read(name) for name in sorted(zf.namelist())
+                                  if name.startswith('xl/')]
+        return content
+
+    def test_report_sql(self):
+        ticket = Ticket(self.env, 2)
+        ticket['owner'] = 'joe'
+        ticket['cc'] = 'joe@example.org, jack'
+        ticket.save_changes('admin', '')
+        @self.env.with_transaction()
+        def fn(db):
+            cursor = db.cursor()
+            cursor.executemany("""
+                INSERT INTO report (id,author,title,query,description)
+                VALUES (%s,'admin',%s,%s,'')""", [
+                (9, 'Semicolon', 'SELECT id AS ticket, summary FROM ticket;'),
+                (10, 'Interleaved groups',
+                 'SELECT status AS __group__, id AS ticket, summary '
+                 'FROM ticket ORDER BY id'),
+                (11, 'Not viewable rows',
+                 "SELECT id AS ticket, summary, "
+                 "CASE WHEN id % 3 = 0 THEN 'hidden' ELSE 'ticket' END "
+                 "AS _realm FROM ticket ORDER BY id"),
+            ])
+        for id in xrange(1, 12):
+            self.assertEqual(self._export_report(id, False),
+                             self._export_report(id, True),
+                             'report %d' % id)
+
+    def test_report_gzip(self):
+        self.env.config.set('exceldownload', 'xls_gzip', 'enabled')
+        self.env.config.set('exceldownload', 'gzip_min_size', '0')
+        mod = ExcelReportModule(self.env)
+        req = MockRequest(self.env, path_info='/report/1',
+                          args={'id': '1', 'format': 'xls'})
+        req.environ['HTTP_ACCEPT_ENCODING'] = 'deflate, gzip;q=0.5'
+        template, data, content_type = \
+            ReportModule(self.env).process_request(req)
+        try:
+            mod.post_process_request(req, template, data, content_type)
+            self.fail('not raising RequestDone')
+        except RequestDone:
+            content = req.response_sent.getvalue()
+        self._assert_content_length(req, content)
+        if self._format == 'xls':
+            self.assertEqual('gzip', req.headers_sent['Content-Encoding'])
+            self.assertEqual('Accept-Encoding', req.headers_sent['Vary'])
+            content = GzipFile(fileobj=StringIO(content)).read()
+        else:
+            self.assertNotIn('Content-Encoding', req.headers_sent)
+        self.assertEqual(self._magic_number, content[:8])
+
+    def _send_query(self, accept_encoding):
+        self.env.enable_component(ExcelTicketModule)
+        mod = ExcelTicketModule(self.env)
+        query = Query.from_string(self.env, 'status=!closed')
+        req = MockRequest(self.env, args={'format': 'excel'})
+        req.environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        mod.pre_process_request(req, QueryModule(self.env))
+        self.assertRaises(RequestDone, Mimeview(self.env).send_converted,
+                          req, 'trac.ticket.Query', query, 'excel', 'query')
+        content = req.response_sent.getvalue()
+        if 'Content-Length' in req.headers_sent:  # unless chunked
+            self.assertEqual(str(len(content)),
+                             req.headers_sent['Content-Length'])
+        self.assertIn('query.', req.headers_sent['Content-Disposition'])
+        return req, content
+
+    def test_query_gzip(self):
+        self.env.config.set('exceldownload', 'xls_gzip', 'enabled')
+        self.env.config.set('exceldownload', 'gzip_min_size', '0')
+        req, content = self._send_query('gzip;q=0')
+        self.assertNotIn('Content-Encoding', req.headers_sent)
+        self.assertEqual(self._magic_number, content[:8])
+
+        for use_chunked_encoding in ('disabled', 'enabled'):
+            self.env.config.set('trac', 'use_chunked_encoding',
+                                use_chunked_encoding)
+            req, content = self._send_query('gzip')
+            if self._format == 'xls':
+                self.assertEqual('gzip', req.headers_sent['Content-Encoding'])
+                self.assertIn('Content-Length', req.headers_sent)
+                content = GzipFile(fileobj=StringIO(content)).read()
+            else:
+                self.assertNotIn('Content-Encoding', req.headers_sent)
+            self.assertEqual(self._magic_number, content[:8])
+
+        # the converter itself leaves the response alone
+        req = MockRequest(self.env)
+        req.environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        query = Query.from_string(self.env, 'status=!closed')
+        content, mimetype = ExcelTicketModule(self.env).convert_content(
+            req, self._mimetype, query, 'excel')
+        self.assertNotIn('Content-Encoding', dict(req._outheaders))
+        self.assertEqual(self._magic_number, ''.join(content)[:8])
+
+    def test_timing_header(self):
+        PermissionSystem(self.env).grant_permission('admin', 'TRAC_ADMIN')
+        mod = ExcelTicketModule(self.env)
+        query = Query.from_string(self.env, 'status=!closed')
+        req = MockRequest(self.env, authname='admin')
+        mod.convert_content(req, self._mimetype, query, 'excel-history')
+        self.assertNotIn('Server-Timing', dict(req._outheaders))
+
+        self.env.config.set('exceldownload', 'timing_header', 'enabled')
+        req = MockRequest(self.env, authname='admin')
+        mod.convert_content(req, self._mimetype, query, 'excel-history')
+        phases = [item.split(';')[0] for item
+                  in dict(req._outheaders)['Server-Timing'].split(', ')]
+        self.assertEqual(['query', 'custom_fields', 'permissions', 'rows',
+                          'col_widths', 'fetch', 'dump', 'total'], phases)
+
+        req = MockRequest(self.env, authname='anonymous')
+        mod.convert_content(req, self._mimetype, query, 'excel-history')
+        self.assertNotIn('Server-Timing', dict(req._outheaders))
+
+    def test_time_budget(self):
+        mod = ExcelTicketModule(self.env)
+        query = Query.from_string(self.env, 'status=!closed')
+        self.env.config.set('exceldownload', 'export_time_budget', '1e-6')
+        req = MockRequest(self.env)
+        self.assertRaises(ExportAborted, mod.convert_content, req,
+                          self._mimetype, query, 'excel-history')
+
+    def test_bulk_fetch_ticket(self):
+        def select():
+            tickets = BulkFetchTicket.select(self.env, tkt_ids)
+            return dict((id, (ticket.values, ticket.get_changelog()))
+                        for id, ticket in tickets.iteritems())
+
+        ticket = Ticket(self.env, 3)
+        ticket['col_text'] = 'changed'
+        ticket.save_changes('admin', 'comment')
+        tkt_ids = [1, 3, 4, 5, 9, 20, 21]
+        expected = select()
+        self.assertEqual([1, 3, 4, 5, 9, 20], sorted(expected))
+        self.assertEqual('changed', expected[3][0]['col_text'])
+        self.assertEqual(2, len(expected[3][1]))
+
+        batch_size = _TicketIdFilter.batch_size
+        threshold = _TicketIdFilter.temp_table_threshold
+        try:
+            _TicketIdFilter.batch_size = 2
+            self.assertEqual(expected, select())
+            _TicketIdFilter.temp_table_threshold = 3
+            self.assertEqual(expected, select())
+            self.assertEqual(expected, select())
+        finally:
+            _TicketIdFilter.batch_size = batch_size
+            _TicketIdFilter.temp_table_threshold = threshold
+
+    def test_ticket_id_filter_failure(self):
+        db = _get_db(self.env)
+        threshold = _TicketIdFilter.temp_table_threshold
+        try:
+            _TicketIdFilter.temp_table_threshold = 3
+            try:
+                with _TicketIdFilter(db, [1, 2, 3]) as id_filter:
+                    db.cursor().execute('DROP TABLE %s' %
+                                        id_filter.temp_table)
+                    raise ValueError('failure in the body')
+            except ValueError, e:
+                self.assertEqual('failure in the body', unicode(e))
+            # the table is created again after a failure
+            with _TicketIdFilter(db, [1, 2, 3]) as id_filter:
+                self.assertEqual([(1,), (2,), (3,)], list(id_filter.select(
+                    'SELECT id FROM ticket WHERE %(cond)s ORDER BY id',
+                    'id')))
+        finally:
+            _TicketIdFilter.temp_table_threshold = threshold
+
+    def test_ticket_history(self):
+        when = datetime(2017, 1, 1, 12, 0, 0, 0, utc)
+        ticket = Ticket(self.env, 3)
+        owner = ticket['owner']
+        ticket['status'] = 'assigned'
+        ticket['owner'] = 'joe'
+        ticket.save_changes('admin', 'first', when)
+        ticket['col_select'] = 'foo'
+        ticket.save_changes('joe', 'second', when + timedelta(hours=1))
+        ticket.save_changes('jack', 'third', when + timedelta(hours=2))
+        ticket['status'] = 'closed'
+        ticket.save_changes('admin', '', when + timedelta(hours=3))
+
+        history = _TicketHistory(BulkFetchTicket.select(self.env, [3])[3])
+        self.assertEqual(5, len(history))
+        rows = [(change.author, change.comment, sorted(change.fields),
+                 change.values['status'], change.values['owner'],
+                 change.values['col_select'])
+                for change in history]
+        self.assertEqual([
+            ('', '', [], 'new', owner, 'baz'),
+            ('admin', 'first', ['owner', 'status'], 'assigned', 'joe', 'baz'),
+            ('joe', 'second', ['col_select'], 'assigned', 'joe', 'foo'),
+            ('jack', 'third', [], 'assigned', 'joe', 'foo'),
+            ('admin', '', ['status'], 'closed', 'joe', 'foo'),
+        ], rows)
+        self.assertEqual(rows, [(change.author, change.comment,
+                                 sorted(change.fields),
+                                 change.values['status'],
+                                 change.values['owner'],
+                                 change.values['col_select'])
+                                for change in history])
+
+    def test_viewable_ids(self):
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env, authname='user')
+        self.assertEqual(set([1, 2, 3]), mod._get_viewable_ids(req, [1, 2, 3]))
+
+        self.env.enable_component(OddTicketsPermissionPolicy)
+        self.env.config.set('trac', 'permission_policies',
+                            'OddTicketsPermissionPolicy, '
+                            'DefaultPermissionPolicy')
+        req = MockRequest(self.env, authname='user')
+        self.assertEqual(set([2]), mod._get_viewable_ids(req, [1, 2, 3]))
+
+        self.env.config.set('trac', 'permission_policies',
+                            'DefaultPermissionPolicy')
+        PermissionSystem(self.env).revoke_permission('anonymous',
+                                                     'TICKET_VIEW')
+        req = MockRequest(self.env, authname='anonymous')
+        self.assertEqual(set(), mod._get_viewable_ids(req, [1, 2, 3]))
+
+    def test_query_data(self):
+        req = MockRequest(self.env)
+        context = Context.from_request(req, 'query')
+        for query_string in ('status=new&group=milestone&col=summary',
+                             'status=new&order=component'):
+            query = Query.from_string(self.env, query_string)
+            tickets = query.execute(req)
+            expected = query.template_data(context, tickets)
+            data = ExcelTicketModule(self.env)._get_query_data(query,
+                                                               tickets)
+            self.assertEqual([(header['name'], header['label'])
+                              for header in expected['headers']],
+                             [(header['name'], header['label'])
+                              for header in data['headers']])
+            self.assertEqual([(value, [ticket['id'] for ticket in results])
+                              for value, results in expected['groups']],
+                             [(value, [ticket['id'] for ticket in results])
+                              for value, results in data['groups']])
+            self.assertEqual(expected['fields']['milestone']['label'],
+                             data['fields']['milestone']['label'])
+
+    def test_author_formatter(self):
+        @self.env.with_transaction()
+        def fn(db):
+            cursor = db.cursor()
+            cursor.execute("INSERT INTO session VALUES ('joe',1,0)")
+            cursor.executemany("INSERT INTO session_attribute "
+                               "VALUES ('joe',1,%s,%s)",
+                               [('name', 'Joe Smith'),
+                                ('email', 'joe@example.org')])
+        chrome = Chrome(self.env)
+        req = MockRequest(self.env)
+        context = Context.from_request(req, 'query')
+        values = ['anonymous', '', 'joe', 'jack@example.org', 'jack']
+        cc = 'joe, jack@example.org;anonymous'
+        for policies in ('DefaultPermissionPolicy',
+                         'OddTicketsPermissionPolicy, '
+                         'DefaultPermissionPolicy'):
+            self.env.enable_component(OddTicketsPermissionPolicy)
+            self.env.config.set('trac', 'permission_policies', policies)
+            authors = _AuthorFormatter(self.env, req, context)
+            for idx in xrange(2):
+                self.assertEqual([chrome.format_author(req, value)
+                                  for value in values],
+                                 [authors.format_author(value)
+                                  for value in values])
+                self.assertEqual(
+                    chrome.format_emails(context('ticket', 1), cc),
+                    authors.format_emails(cc, 'ticket', 1))
+
+    def test_column_plan(self):
+        req = MockRequest(self.env)
+        context = Context.from_request(req, 'query', absurls=True)
+        book = get_workbook_writer(self.env, req)
+        headers = [{'name': name} for name in ('summary', 'tt_spent', 'time',
+                                               'milestone', 'cc')]
+        authors = _AuthorFormatter(self.env, req, context)
+        plan = ExcelTicketModule(self.env)._get_column_plan(authors, headers,
+                                                            book)
+        when = datetime(2017, 1, 1, tzinfo=utc)
+        cc = Chrome(self.env).format_emails(context('ticket', 1),
+                                            'joe@example.org')
+        self.assertEqual(
+            [(u'Summary', book.resolve_style('summary'), None, None),
+             (1.5, book.resolve_style('tt_spent'), 3, None),
+             (when, book.resolve_style('[datetime]'), None, None),
+             ('', book.resolve_style('milestone'), None, None),
+             (cc, book.resolve_style('cc'), None, None)],
+            [convert(value, 1) for convert, value
+             in zip(plan, (u'Summary', '1.5', when, '', 'joe@example.org'))])
+        plan = ExcelTicketModule(self.env)._get_column_plan(
+            authors, headers, book, ':change')
+        self.assertEqual(book.resolve_style('tt_spent:change'),
+                         plan[1]('', 1)[1])
+
+        header_groups = [[{'col': 'ticket', 'hidden': False},
+                          {'col': '__color__', 'hidden': True},
+                          {'col': 'created', 'hidden': False}]]
+        plan = ExcelReportModule(self.env)._get_column_plan(header_groups,
+                                                            book)
+        self.assertEqual(None, plan[0][1])
+        self.assertEqual((42, book.resolve_style('id'), 3, 1), plan[0][0](42))
+        value, style, width, line = plan[0][2]('1483228800000000')
+        self.assertEqual((when, book.resolve_style('[date]'), 10),
+                         (value, style, width))
+
+    def test_query_spooled(self):
+        self.env.config.set('exceldownload', 'spool_size', '1024')
+        mod = ExcelTicketModule(self.env)
+        req = MockRequest(self.env)
+        query = Query.from_string(self.env, 'status=!closed')
+        content, mimetype = mod.convert_content(req, self._mimetype, query,
+                                                'excel-history')
+        self.assertFalse(isinstance(content, basestring))
+        chunks = list(content)
+        self.assertTrue(len(chunks) >= 1)
+        self.assertEqual(self._magic_number, chunks[0][:8])
 
 
 class Excel2003TicketTestCase(AbstractExcelTicketTestCase):
@@ -108,8 +479,16 @@ class Excel2007TicketTestCase(AbstractExcelTicketTestCase):
     _magic_number = b'PK\x03\x04\x14\x00\x00\x00'
 
 
+class Excel2007NativeTicketTestCase(Excel2007TicketTestCase):
+
+    _format = 'xlsx-native'
+    # the sizes of an entry follow its content in a data descriptor
+    _magic_number = b'PK\x03\x04\x14\x00\x08\x00'
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Excel2003TicketTestCase))
     suite.addTest(unittest.makeSuite(Excel2007TicketTestCase))
+    suite.addTest(unittest.makeSuite(Excel2007NativeTicketTestCase))
     return suite
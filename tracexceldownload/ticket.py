@@ -1,34 +1,46 @@
 # -*- coding: utf-8 -*-
 
+import cPickle
 import inspect
 import re
 import types
 from datetime import datetime
 from itertools import chain, groupby
-from xlwt import Formula
+from tempfile import SpooledTemporaryFile
 
 from trac.core import Component, implements
 from trac.env import Environment
-from trac.mimeview.api import Context, IContentConverter
-from trac.resource import Resource, get_resource_url
+from trac.mimeview.api import Context, IContentConverter, Mimeview
+from trac.resource import Resource
 from trac.ticket.api import TicketSystem
 from trac.ticket.model import Ticket
 from trac.ticket.query import Query
-from trac.ticket.web_ui import TicketModule
-from trac.util import Ranges
-from trac.util.text import empty, unicode_urlencode
+from trac.ticket.report import (LIMIT_OFFSET, SORT_COLUMN, ReportModule,
+                                cell_value, sub_vars)
+from trac.util.datefmt import format_datetime, to_utimestamp, utc
+from trac.util.text import (empty, exception_to_unicode, to_unicode,
+                            unicode_urlencode)
 from trac.web.api import IRequestFilter, RequestDone
 from trac.web.chrome import Chrome, add_link
 try:
     from trac.util.datefmt import from_utimestamp
 except ImportError:
     from datetime import timedelta
-    from trac.util.datefmt import utc
     _epoc = datetime(1970, 1, 1, tzinfo=utc)
     from_utimestamp = lambda ts: _epoc + timedelta(seconds=ts or 0)
 
-from tracexceldownload.api import (get_excel_format, get_excel_mimetype,
-                                   get_workbook_writer, get_literal)
+from tracexceldownload.api import (ExcelDownloadConfig, ExportCanceller,
+                                   ExportTimings, Hyperlink,
+                                   _get_datetime_width, encode_content,
+                                   encode_converted, get_excel_format,
+                                   get_excel_mimetype,
+                                   get_permission_fingerprint,
+                                   get_workbook_writer,
+                                   has_fine_grained_policies,
+                                   send_file_header)
+from tracexceldownload.cache import ExcelDownloadCache
+from tracexceldownload.delta import ExcelDeltaTokens
+from tracexceldownload.jobs import ExcelExportJobModule
 from tracexceldownload.translation import _, dgettext, dngettext
 
 
@@ -37,22 +49,107 @@ if hasattr(Environment, 'get_read_db'):
 else:
     _get_db = lambda env: env.get_db_cnx()
 
-
-def _tkt_id_conditions(column, tkt_ids):
-    ranges = Ranges()
-    ranges.appendrange(','.join(map(str, sorted(tkt_ids))))
-    condition = []
-    tkt_ids = []
-    for a, b in ranges.pairs:
-        if a == b:
-            tkt_ids.append(a)
-        elif a + 1 == b:
-            tkt_ids.extend((a, b))
-        else:
-            condition.append('%s BETWEEN %d AND %d' % (column, a, b))
-    if tkt_ids:
-        condition.append('%s IN (%s)' % (column, ','.join(map(str, tkt_ids))))
-    return ' OR '.join(condition)
+# Trac 1.0.6+ accepts an iterable from `IContentConverter.convert_content`
+_iterable_content = \
+    'iterable' in inspect.getargspec(Mimeview.convert_content)[0]
+
+
+def _get_content(content):
+    """Return the chunk iterator of a `(size, iterator)` tuple in the form
+    which `IContentConverter.convert_content` can return, joined into a
+    single string before Trac 1.0.6. Trac joins it as well unless
+    `[trac] use_chunked_encoding` is enabled, as it sends the size.
+    """
+    size, iterator = content
+    if _iterable_content:
+        return iterator
+    return ''.join(iterator)
+
+
+def _restrict_changetime(query, since):
+    """Add a constraint on the tickets changed since `since` to each clause
+    of `query` which doesn't constrain `changetime` yet.
+    """
+    value = since.astimezone(utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ') + '..'
+    constraints = query.constraints
+    if isinstance(constraints, dict):  # Trac 0.12
+        constraints = [constraints]
+    elif not constraints:
+        constraints.append({})
+    for clause in constraints:
+        clause.setdefault('changetime', [value])
+
+
+class _TicketIdFilter(object):
+    """Restrict queries to a set of ticket ids without rendering the ids
+    into the SQL. Small sets are passed as parameters in fixed-size
+    batches, large sets are stored in a temporary table which the queries
+    join.
+    """
+
+    batch_size = 500  # SQLite allows up to 999 parameters
+    temp_table_threshold = 10000
+    temp_table = 'tracexceldownload_ids'
+
+    def __init__(self, db, tkt_ids):
+        self.db = db
+        self.tkt_ids = sorted(set(tkt_ids))
+        self._use_temp_table = False
+
+    def __enter__(self):
+        tkt_ids = self.tkt_ids
+        if len(tkt_ids) >= self.temp_table_threshold:
+            cursor = self.db.cursor()
+            cursor.execute('CREATE TEMPORARY TABLE %s '
+                           '(id integer PRIMARY KEY)' % self.temp_table)
+            self._use_temp_table = True
+            sql = 'INSERT INTO %s (id) VALUES (%%s)' % self.temp_table
+            try:
+                for idx in xrange(0, len(tkt_ids), self.batch_size):
+                    cursor.executemany(sql, [
+                        (id,) for id in tkt_ids[idx:idx + self.batch_size]])
+            except:
+                self._drop_temp_table(failed=True)
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._drop_temp_table(failed=exc_type is not None)
+
+    def _drop_temp_table(self, failed):
+        if not self._use_temp_table:
+            return
+        self._use_temp_table = False
+        try:
+            self.db.cursor().execute('DROP TABLE %s' % self.temp_table)
+        except Exception:
+            # Don't mask the original failure, e.g. PostgreSQL refuses
+            # any statement in the aborted transaction, whose rollback
+            # drops the table anyway.
+            if not failed:
+                raise
+
+    def select(self, sql, column):
+        """Yield the rows of `sql` whose `column` is one of the ticket ids.
+        `sql` must contain `%(cond)s` for the condition. When `sql` is
+        ordered by `column`, the rows are yielded in that order.
+        """
+        cursor = self.db.cursor()
+        if self._use_temp_table:
+            cursor.execute(sql % {'cond': '%s IN (SELECT id FROM %s)' %
+                                          (column, self.temp_table)})
+            for row in cursor:
+                yield row
+            return
+        tkt_ids = self.tkt_ids
+        for idx in xrange(0, len(tkt_ids), self.batch_size):
+            batch = tkt_ids[idx:idx + self.batch_size]
+            cursor.execute(sql % {'cond': '%s IN (%s)' %
+                                          (column, ','.join(['%s'] *
+                                                            len(batch)))},
+                           batch)
+            for row in cursor:
+                yield row
 
 
 class BulkFetchTicket(Ticket):
@@ -67,13 +164,18 @@ class BulkFetchTicket(Ticket):
         std_fields = [f['name'] for f in fields if not f.get('custom')]
         time_fields = [f['name'] for f in fields if f['type'] == 'time']
         custom_fields = set(f['name'] for f in fields if f.get('custom'))
-        cursor = db.cursor()
+        with _TicketIdFilter(db, tkt_ids) as id_filter:
+            return cls._select(env, id_filter, fields, std_fields,
+                               time_fields, custom_fields)
+
+    @classmethod
+    def _select(cls, env, id_filter, fields, std_fields, time_fields,
+                custom_fields):
         tickets = {}
 
-        cursor.execute('SELECT %s,id FROM ticket WHERE %s' %
-                       (','.join(std_fields),
-                        _tkt_id_conditions('id', tkt_ids)))
-        for row in cursor:
+        rows = id_filter.select('SELECT %s,id FROM ticket WHERE %%(cond)s' %
+                                ','.join(std_fields), 'id')
+        for row in rows:
             id = row[-1]
             values = {}
             for idx, field in enumerate(std_fields):
@@ -85,10 +187,9 @@ class BulkFetchTicket(Ticket):
                 values[field] = value
             tickets[id] = (values, [])  # values, changelog
 
-        cursor.execute('SELECT ticket,name,value FROM ticket_custom '
-                       'WHERE %s ORDER BY ticket' %
-                       _tkt_id_conditions('ticket', tkt_ids))
-        for id, rows in groupby(cursor, lambda row: row[0]):
+        rows = id_filter.select('SELECT ticket,name,value FROM ticket_custom '
+                                'WHERE %(cond)s ORDER BY ticket', 'ticket')
+        for id, rows in groupby(rows, lambda row: row[0]):
             if id not in tickets:
                 continue
             values = {}
@@ -99,10 +200,11 @@ class BulkFetchTicket(Ticket):
                     values[name] = value
             tickets[id][0].update(values)
 
-        cursor.execute('SELECT ticket,time,author,field,oldvalue,newvalue '
-                       'FROM ticket_change WHERE %s ORDER BY ticket,time' %
-                       _tkt_id_conditions('ticket', tkt_ids))
-        for id, rows in groupby(cursor, lambda row: row[0]):
+        rows = id_filter.select('SELECT ticket,time,author,field,oldvalue,'
+                                'newvalue FROM ticket_change '
+                                'WHERE %(cond)s ORDER BY ticket,time',
+                                'ticket')
+        for id, rows in groupby(rows, lambda row: row[0]):
             if id not in tickets:
                 continue
             tickets[id][1].extend(
@@ -139,9 +241,134 @@ class BulkFetchTicket(Ticket):
         return self._changelog[:]
 
 
+class _TicketChange(object):
+
+    __slots__ = ('date', 'author', 'comment', 'fields', 'values')
+
+    def __init__(self, date, author, comment, fields, values=None):
+        self.date = date
+        self.author = author
+        self.comment = comment
+        self.fields = fields
+        self.values = values
+
+
+class _TicketHistory(object):
+    """Replay the changelog of a ticket forward from its state at creation.
+
+    The changelog is grouped like `TicketModule.grouped_changelog_entries`
+    but each change only keeps the values of its changed fields. Iterating
+    yields the changes with `values` set to a snapshot which is shared by
+    all changes and updated in place, so the values of a change must be
+    read before advancing to the next one.
+    """
+
+    def __init__(self, ticket):
+        self.ticket = ticket
+        changes = list(self._group(ticket.get_changelog()))
+        # walk backwards from the current values to the values at creation,
+        # keeping the value after each change like the original rows did
+        self._initial = values = ticket.values.copy()
+        for change, olds in reversed(changes):
+            fields = change.fields
+            for name in fields:
+                if name in values:
+                    fields[name] = values[name]
+                    values[name] = olds[name]
+        self.changes = [change for change, olds in changes]
+
+    def __len__(self):
+        return len(self.changes) + 1
+
+    def __iter__(self):
+        ticket = self.ticket
+        values = self._initial.copy()
+        yield _TicketChange(ticket.time_created, ticket['reporter'], '', {},
+                            values)
+        for change in self.changes:
+            for name, value in change.fields.iteritems():
+                if name in values:
+                    values[name] = value
+            change.values = values
+            yield change
+            change.values = None
+
+    def _group(self, changelog):
+        for date, rows in groupby(changelog, lambda row: row[0]):
+            author = None
+            comment = ''
+            fields = {}
+            olds = {}
+            for date, author_, field, old, new, permanent in rows:
+                if not permanent:
+                    continue
+                if field == 'comment':
+                    comment = new
+                    author = author_
+                elif field.startswith('_'):
+                    continue
+                else:
+                    if author is None:
+                        author = author_
+                    if (old or new) and old != new:
+                        fields[field] = new
+                        olds[field] = old
+            yield _TicketChange(date, author or '', comment, fields), olds
+
+
+class _AuthorFormatter(object):
+    """Format authors and lists of e-mails with `Chrome` for the cells of
+    an export, remembering the result of each distinct value. Unless a
+    fine-grained permission policy decides on `EMAIL_VIEW`, the results
+    only depend on the value and the realm.
+    """
+
+    def __init__(self, env, req, context):
+        self.chrome = Chrome(env)
+        self.req = req
+        self.context = context
+        self.fine_grained = has_fine_grained_policies(env)
+        self._authors = {}
+        self._emails = {}
+
+    def format_author(self, author):
+        try:
+            return self._authors[author]
+        except KeyError:
+            formatted = self.chrome.format_author(self.req, author)
+            self._authors[author] = formatted
+            return formatted
+
+    def format_emails(self, value, realm, id=None, parent=None):
+        if self.fine_grained:
+            context = self.context.child(Resource(realm, id, parent=parent))
+            return self.chrome.format_emails(context, value)
+        key = (realm, value)
+        try:
+            return self._emails[key]
+        except KeyError:
+            context = self.context.child(Resource(realm))
+            formatted = self.chrome.format_emails(context, value)
+            self._emails[key] = formatted
+            return formatted
+
+
 class ExcelTicketModule(Component):
 
-    implements(IContentConverter)
+    implements(IContentConverter, IRequestFilter)
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if req.args.get('format') in ('excel', 'excel-history') and \
+                handler.__class__.__name__ in ('QueryModule', 'TicketModule'):
+            encode_converted(self.env, req)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # IContentConverter methods
 
     def get_supported_conversions(self):
         format = get_excel_format(self.env)
@@ -155,21 +382,54 @@ class ExcelTicketModule(Component):
 
     def convert_content(self, req, mimetype, content, key):
         if key == 'excel':
-            return self._convert_query(req, content)
-        if key == 'excel-history':
+            filename = 'query'
+            kwargs = {}
+        elif key == 'excel-history':
             kwargs = {}
             if isinstance(content, Ticket):
+                filename = 'ticket_%d' % content.id
                 content = Query.from_string(self.env, 'id=%d' % content.id)
                 kwargs['sheet_query'] = False
                 kwargs['sheet_history'] = True
             else:
+                filename = 'query'
                 kwargs['sheet_query'] = True
                 kwargs['sheet_history'] = True
-            return self._convert_query(req, content, **kwargs)
-
-    def _convert_query(self, req, query, sheet_query=True,
-                       sheet_history=False):
-        book = get_workbook_writer(self.env, req)
+        else:
+            return None
+        since = req.args.get('since')
+        if since is not None and kwargs.get('sheet_query', True):
+            kwargs['since'] = since
+
+        jobs = ExcelExportJobModule(self.env)
+        if jobs.is_requested(req):
+            filename += '.' + get_excel_format(self.env)
+            jobs.enqueue(req, filename,
+                         lambda req: self._convert_query(req, content,
+                                                         **kwargs))
+        return self._convert_query(req, content, **kwargs)
+
+    def _convert_query(self, req, query, **kwargs):
+        # the sheets are complete at this point, an xlsx-native archive is
+        # written while the response is sent and the other formats are
+        # read back from the spool
+        content, mimetype = self._create_query(req, query, **kwargs)
+        return _get_content(content), mimetype
+
+    def _create_query(self, req, query, sheet_query=True,
+                      sheet_history=False, since=None):
+        timings = ExportTimings(self.env, 'query')
+        canceller = ExportCanceller(self.env, req)
+        query_string = query.to_string()
+
+        # delta export of the tickets changed since a date or a token
+        delta = since is not None
+        if delta:
+            tokens = ExcelDeltaTokens(self.env)
+            started = datetime.now(utc)
+            since, previous = tokens.parse_since(req, since, query_string)
+            if since:
+                _restrict_changetime(query, since)
 
         # no paginator
         query.max = 0
@@ -191,26 +451,134 @@ class ExcelTicketModule(Component):
         try:
             query._count = types.MethodType(lambda self, sql, args, db=None: 0,
                                             query, query.__class__)
-            if 'db' in inspect.getargspec(query.execute)[0]:
-                tickets = query.execute(req, db)
-            else:
-                tickets = query.execute(req)
+            with timings.phase('query'):
+                if 'db' in inspect.getargspec(query.execute)[0]:
+                    tickets = query.execute(req, db)
+                else:
+                    tickets = query.execute(req)
+            if since:
+                # the query may already have its own changetime constraint
+                tickets = [ticket for ticket in tickets
+                                  if ticket['changetime'] >= since]
             query.num_items = len(tickets)
         finally:
             query._count = saved_count_prop
 
+        cache = ExcelDownloadCache(self.env)
+        cache_key = None if delta else cache.get_key(
+            'query', query_string, sheet_query, sheet_history,
+            ExcelDownloadConfig(self.env).format,
+            get_permission_fingerprint(self.env, req), req.tz,
+            getattr(req, 'locale', None),
+            max([ticket['changetime'] for ticket in tickets] or [None]),
+            ','.join(str(ticket['id']) for ticket in tickets))
+        if cache_key:
+            with timings.phase('cache'):
+                content = cache.fetch(cache_key)
+            if content:
+                timings.report(req)
+                mimetype = get_excel_mimetype(get_excel_format(self.env))
+                return content, mimetype
+
         # add custom fields to avoid error to join many tables
-        self._fill_custom_fields(tickets, query.fields, custom_fields, db)
+        with timings.phase('custom_fields'):
+            self._fill_custom_fields(tickets, query.fields, custom_fields, db)
 
         context = Context.from_request(req, 'query', absurls=True)
+        authors = _AuthorFormatter(self.env, req, context)
         cols.extend([name for name in custom_fields if name not in cols])
-        data = query.template_data(context, tickets)
+        data = self._get_query_data(query, tickets)
 
+        with timings.phase('permissions'):
+            viewable = self._get_viewable_ids(
+                req, [ticket['id'] for ticket in tickets])
+        book = get_workbook_writer(self.env, req)
         if sheet_query:
-            self._create_sheet_query(req, context, data, book)
+            self._create_sheet_query(req, authors, data, book, viewable,
+                                     timings, canceller)
         if sheet_history:
-            self._create_sheet_history(req, context, data, book)
-        return book.dumps(), book.mimetype
+            self._create_sheet_history(req, authors, data, book, viewable,
+                                       timings, canceller)
+        if delta:
+            with timings.phase('delta'):
+                tkt_ids = set(ticket['id'] for ticket in tickets)
+                removed = self._get_removed_tickets(req, since, previous,
+                                                    tkt_ids, db)
+                token = None
+                if since is None or previous is not None:
+                    tkt_ids &= viewable
+                    tkt_ids.update(id for id in previous or ()
+                                      if id not in removed)
+                    token = tokens.issue(req, query_string, started, tkt_ids)
+                    send_file_header(req, 'X-Excel-Delta-Token', token)
+                self._create_sheet_delta(req, book, since, removed, token)
+        canceller.check()
+        with timings.phase('dump'):
+            if cache_key:
+                content = cache.store(cache_key, book)
+            else:
+                content = book.iterdump()
+        timings.report(req)
+        return content, book.mimetype
+
+    def _get_query_data(self, query, tickets):
+        """Return the headers, the fields and the groups of `tickets` like
+        `Query.template_data` without the data for the HTML page.
+        """
+        labels = dict((field['name'], field['label'])
+                      for field in query.fields)
+        headers = [{'name': col,
+                    'label': labels.get(col, dgettext('messages', 'Ticket'))}
+                   for col in query.get_columns()]
+        fields = {'id': {'type': 'id',
+                         'label': dgettext('messages', 'Ticket')}}
+        fields.update((field['name'], field) for field in query.fields)
+
+        groups = []
+        if query.group:
+            group_tickets = {}
+            for ticket in tickets:
+                value = ticket[query.group]
+                if value not in group_tickets:
+                    group_tickets[value] = []
+                    groups.append((value, group_tickets[value]))
+                group_tickets[value].append(ticket)
+        return {'query': query, 'headers': headers, 'fields': fields,
+                'groups': groups or [(None, tickets)]}
+
+    def _get_viewable_ids(self, req, tkt_ids):
+        """Return the set of `tkt_ids` which the user is allowed to view.
+        Each ticket is checked only when the user lacks `TICKET_VIEW` for
+        the whole realm or a fine-grained permission policy is active.
+        """
+        if 'TICKET_VIEW' in req.perm('ticket') and \
+                not has_fine_grained_policies(self.env):
+            return set(tkt_ids)
+        return set(id for id in tkt_ids
+                      if 'TICKET_VIEW' in req.perm('ticket', id))
+
+    def _get_removed_tickets(self, req, since, previous, tkt_ids, db):
+        """Return a dictionary of the reasons why the tickets of the
+        previous export are missing from the delta export of `tkt_ids`.
+        """
+        if not previous:
+            return {}
+        changetimes = {}
+        with _TicketIdFilter(db, previous) as id_filter:
+            for id, changetime in id_filter.select(
+                    "SELECT id,changetime FROM ticket WHERE %(cond)s", 'id'):
+                changetimes[id] = changetime
+        viewable = self._get_viewable_ids(req, changetimes)
+        since = to_utimestamp(since)
+        removed = {}
+        for id in previous:
+            if id not in changetimes:
+                removed[id] = _("Deleted")
+            elif id not in viewable:
+                removed[id] = _("Not viewable")
+            elif id not in tkt_ids and changetimes[id] >= since:
+                removed[id] = _("No longer matching")
+        return removed
 
     def _fill_custom_fields(self, tickets, fields, custom_fields, db):
         if not tickets or not custom_fields:
@@ -218,23 +586,22 @@ class ExcelTicketModule(Component):
         fields = dict((f['name'], f) for f in fields)
         tickets = dict((int(ticket['id']), ticket) for ticket in tickets)
         query = "SELECT ticket,name,value " \
-                "FROM ticket_custom WHERE %s ORDER BY ticket" % \
-                _tkt_id_conditions('ticket', tickets)
-
-        cursor = db.cursor()
-        cursor.execute(query)
-        for id, name, value in cursor:
-            if id not in tickets:
-                continue
-            f = fields.get(name)
-            if f and f['type'] == 'checkbox':
-                try:
-                    value = bool(int(value))
-                except (TypeError, ValueError):
-                    value = False
-            tickets[id][name] = value
-
-    def _create_sheet_query(self, req, context, data, book):
+                "FROM ticket_custom WHERE %(cond)s ORDER BY ticket"
+
+        with _TicketIdFilter(db, tickets) as id_filter:
+            for id, name, value in id_filter.select(query, 'ticket'):
+                if id not in tickets:
+                    continue
+                f = fields.get(name)
+                if f and f['type'] == 'checkbox':
+                    try:
+                        value = bool(int(value))
+                    except (TypeError, ValueError):
+                        value = False
+                tickets[id][name] = value
+
+    def _create_sheet_query(self, req, authors, data, book, viewable,
+                            timings, canceller):
         def write_headers(writer, query):
             writer.write_row([(
                 u'%s (%s)' % (dgettext('messages', 'Custom Query'),
@@ -247,15 +614,21 @@ class ExcelTicketModule(Component):
         fields = data['fields']
         headers = data['headers']
 
+        col_width_hints = self._get_col_width_hints(headers, fields, book)
+        plan = zip([header['name'] for header in headers],
+                   self._get_column_plan(authors, headers, book))
+
         sheet_count = 1
         sheet_name = dgettext("messages", "Custom Query")
         writer = book.create_sheet(sheet_name)
+        writer.set_col_width_hints(col_width_hints)
         write_headers(writer, query)
 
+        started = timings.start()
+        nrows = ncells = 0
         for groupname, results in groups:
             results = [result for result in results
-                              if 'TICKET_VIEW' in req.perm(
-                                 context('ticket', result['id']).resource)]
+                              if result['id'] in viewable]
             if not results:
                 continue
 
@@ -263,13 +636,14 @@ class ExcelTicketModule(Component):
                 sheet_count += 1
                 writer = book.create_sheet('%s (%d)' % (sheet_name,
                                                         sheet_count))
+                writer.set_col_width_hints(col_width_hints)
                 write_headers(writer, query)
 
             if groupname:
                 writer.move_row()
                 cell = fields[query.group]['label'] + ' '
                 if query.group in ('owner', 'reporter'):
-                    cell += Chrome(self.env).format_author(req, groupname)
+                    cell += authors.format_author(groupname)
                 else:
                     cell += groupname
                 cell += ' (%s)' % dngettext('messages', '%(num)s match',
@@ -280,18 +654,20 @@ class ExcelTicketModule(Component):
                              for idx, header in enumerate(headers))
 
             for result in results:
-                ticket_context = context('ticket', result['id'])
-                cells = []
-                for idx, header in enumerate(headers):
-                    name = header['name']
-                    value, style, width, line = self._get_cell_data(
-                        name, result.get(name), req, ticket_context, writer)
-                    cells.append((value, style, width, line))
+                tkt_id = result['id']
+                cells = [convert(result.get(name), tkt_id)
+                         for name, convert in plan]
                 writer.write_row(cells)
+                nrows += 1
+                ncells += len(cells)
+                canceller.checkpoint()
+        timings.stop('rows', started, nrows, ncells)
 
-        writer.set_col_widths()
+        with timings.phase('col_widths'):
+            writer.set_col_widths()
 
-    def _create_sheet_history(self, req, context, data, book):
+    def _create_sheet_history(self, req, authors, data, book, viewable,
+                              timings, canceller):
         def write_headers(writer, headers):
             writer.write_row((header['label'], 'thead', None, None)
                              for idx, header in enumerate(headers))
@@ -306,168 +682,175 @@ class ExcelTicketModule(Component):
             {'name': 'comment', 'label': dgettext("messages", "Comment")},
         ]
 
+        col_width_hints = self._get_col_width_hints(headers, data['fields'],
+                                                    book)
+        names = [header['name'] for header in headers]
+        plan = zip(names,
+                   self._get_column_plan(authors, headers, book),
+                   self._get_column_plan(authors, headers, book, ':change'))
+
         sheet_name = dgettext("messages", "Change History")
         sheet_count = 1
         writer = book.create_sheet(sheet_name)
+        writer.set_col_width_hints(col_width_hints)
         write_headers(writer, headers)
 
         tkt_ids = [result['id']
                    for result in chain(*[results for groupname, results
-                                                 in groups])]
-        tickets = BulkFetchTicket.select(self.env, tkt_ids)
-
-        mod = TicketModule(self.env)
-        for result in chain(*[results for groupname, results in groups]):
-            id = result['id']
-            ticket = tickets[id]
-            ticket_context = context('ticket', id)
-            if 'TICKET_VIEW' not in req.perm(ticket_context.resource):
-                continue
-            values = ticket.values.copy()
-            changes = []
-
-            for change in mod.grouped_changelog_entries(ticket, None):
-                if change['permanent']:
-                    changes.append(change)
-            for change in reversed(changes):
-                change['values'] = values
-                values = values.copy()
-                for name, field in change['fields'].iteritems():
-                    if name in values:
-                        values[name] = field['old']
-            changes[0:0] = [{'date': ticket.time_created, 'fields': {},
-                             'values': values, 'cnum': None,
-                             'comment': '', 'author': ticket['reporter']}]
-
-            if writer.row_idx + len(changes) >= writer.MAX_ROWS:
+                                                 in groups])
+                   if result['id'] in viewable]
+        with timings.phase('fetch'):
+            tickets = BulkFetchTicket.select(self.env, tkt_ids)
+
+        started = timings.start()
+        nrows = ncells = 0
+        for id in tkt_ids:
+            history = _TicketHistory(tickets[id])
+
+            if writer.row_idx + len(history) >= writer.MAX_ROWS:
                 sheet_count += 1
                 writer = book.create_sheet('%s (%d)' % (sheet_name,
                                                         sheet_count))
+                writer.set_col_width_hints(col_width_hints)
                 write_headers(writer, headers)
 
-            for change in changes:
-                cells = []
-                for idx, header in enumerate(headers):
-                    name = header['name']
-                    if name == 'id':
-                        value = id
-                    elif name == 'time':
-                        value = change.get('date', '')
-                    elif name == 'comment':
-                        value = change.get('comment', '')
-                    elif name == 'author':
-                        value = change.get('author', '')
-                        value = Chrome(self.env).format_author(req, value)
-                    else:
-                        value = change['values'].get(name, '')
-                    value, style, width, line = \
-                            self._get_cell_data(name, value, req,
-                                                ticket_context, writer)
-                    if name in change['fields']:
-                        style = '%s:change' % style
-                    cells.append((value, style, width, line))
+            for change in history:
+                values = change.values
+                fields = change.fields
+                row = [id, change.date, authors.format_author(change.author),
+                       change.comment]
+                row.extend(values.get(name, '') for name in names[4:])
+                cells = [(convert_change if name in fields else convert)(
+                             value, id)
+                         for value, (name, convert, convert_change)
+                         in zip(row, plan)]
                 writer.write_row(cells)
-
+                nrows += 1
+                ncells += len(cells)
+                canceller.checkpoint()
+        timings.stop('rows', started, nrows, ncells)
+
+        with timings.phase('col_widths'):
+            writer.set_col_widths()
+
+    def _create_sheet_delta(self, req, book, since, removed, token):
+        writer = book.create_sheet(_("Removed Tickets"))
+        if since:
+            title = _("Changes since %(date)s",
+                      date=format_datetime(since, tzinfo=req.tz))
+        else:
+            title = _("All tickets")
+        writer.write_row([(title, 'header', -1, -1)])
+        if token:
+            writer.write_row([(_("Token for the next delta export: %(token)s",
+                                 token=token), '*', -1, -1)])
+        writer.move_row()
+        writer.write_row([(dgettext("messages", "Ticket"), 'thead', None, None),
+                          (_("Reason"), 'thead', None, None)])
+        for id in sorted(removed):
+            writer.write_row([(id, 'id', len('#%d' % id), 1),
+                              (removed[id], '*', None, None)])
         writer.set_col_widths()
 
-    def _get_cell_data(self, name, value, req, context, writer):
-
-        if name == 'tt_spent':
-            if not value:
-                value = 0
-                return value, name, None, None
-            width = len(value)
-            try:
-                value = float(value)
-            except ValueError:
-                pass  # leave value as is
-            return value, name, width, None
-
-        if name == 'tt_estimated':
-            if not value:
-                value = 0
-                return value, name, None, None
-            width = len(value)
-            try:
-                value = float(value)
-            except ValueError:
-                pass  # leave value as is
-            return value, name, width, None
-
-        if name == 'tt_remaining':
-            if not value:
-                value = 0
-                return value, name, None, None
-            width = len(value)
-            try:
-                value = float(value)
-            except ValueError:
-                pass  # leave value as is
-            return value, name, width, None
-
-        if name == 'br_planned':
-            if not value:
-                value = 0
-                return value, name, None, None
-            width = len(value)
-            try:
-                value = float(value)
-            except ValueError:
-                pass  # leave value as is
-            return value, name, width, None
-
-        if name == 'children':
-            # this never has a value for some reason
-            pass
+    def _get_col_width_hints(self, headers, fields, book):
+        hints = {}
+        for idx, header in enumerate(headers):
+            field = fields.get(header['name'])
+            if not field:
+                continue
+            if field['type'] == 'textarea':
+                hints[idx] = 50
+            elif field['type'] in ('select', 'radio'):
+                options = [option for option in field.get('options') or ()
+                                  if isinstance(option, basestring)]
+                if options:
+                    hints[idx] = max(book.get_metrics(option)[0]
+                                     for option in options)
+        return hints
+
+    def _get_column_plan(self, authors, headers, book, suffix=''):
+        """Return the converters of the columns for `headers`. Each
+        converter takes the value and the id of a ticket and returns a cell
+        tuple for `write_row()` with the style resolved by `book`.
+        """
+        return [self._get_cell_converter(authors, header['name'], book,
+                                         suffix)
+                for header in headers]
+
+    def _get_cell_converter(self, authors, name, book, suffix):
+        style = book.resolve_style(name + suffix)
+        datetime_style = book.resolve_style('[datetime]' + suffix)
+        abs_href = self.env.abs_href
+
+        if name in ('tt_spent', 'tt_estimated', 'tt_remaining',
+                    'br_planned'):
+            def convert(value, tkt_id):
+                if not value:
+                    return 0, style, None, None
+                width = len(value)
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass  # leave value as is
+                return value, style, width, None
+            return convert
 
         if name == 'parent':
-            if not value:
-                value = ''
-                return value, name, None, None
-            values = re.findall('[\d]+', value)
-            parents = ''
-            if len(values) == 1:
-                value = values[0]
-                url = self.env.abs_href.ticket(value)
-                value = '#%d' % int(value)
-                value = Formula('HYPERLINK("%s",%s)' % (url, get_literal(value)))
-                width = len(values[0])
-                return value, name, width, 1
-            for value in values:
-                # hyperlinks aren't working with multiple parents, set as string
-                url = self.env.abs_href.ticket(value)
-                value = '#%d' % int(value)
-                parents += value + ' '
-            width = len(values) * 3
-            return parents, name, width, 1
+            def convert(value, tkt_id):
+                if not value:
+                    return '', style, None, None
+                values = re.findall('[\d]+', value)
+                if len(values) == 1:
+                    value = values[0]
+                    url = abs_href.ticket(value)
+                    value = Hyperlink(url, '#%d' % int(value))
+                    return value, style, len(values[0]), 1
+                # hyperlinks aren't working with multiple parents, set as
+                # string
+                parents = ''.join('#%d ' % int(value) for value in values)
+                return parents, style, len(values) * 3, 1
+            return convert
 
         if name == 'id':
-            url = self.env.abs_href.ticket(value)
-            value = '#%d' % value
-            width = len(value)
-            value = Formula('HYPERLINK("%s",%s)' % (url, get_literal(value)))
-            return value, 'id', width, 1
-
-        if isinstance(value, datetime):
-            return value, '[datetime]', None, None
-
-        if value and name in ('reporter', 'owner'):
-            value = Chrome(self.env).format_author(req, value)
-            return value, name, None, None
-
-        if name == 'cc':
-            value = Chrome(self.env).format_emails(context, value)
-            return value, name, None, None
-
-        if name == 'milestone':
-            if value:
-                url = self.env.abs_href.milestone(value)
-                width, line = writer.get_metrics(value)
-                return value, name, width, line
-            else:
-                return '', name, None, None
+            style = book.resolve_style('id' + suffix)
+            def convert(value, tkt_id):
+                url = abs_href.ticket(value)
+                value = '#%d' % value
+                return Hyperlink(url, value), style, len(value), 1
+            return convert
+
+        if name in ('reporter', 'owner'):
+            def convert(value, tkt_id):
+                if isinstance(value, datetime):
+                    return value, datetime_style, None, None
+                if value:
+                    value = authors.format_author(value)
+                return value, style, None, None
+        elif name == 'cc':
+            def convert(value, tkt_id):
+                if isinstance(value, datetime):
+                    return value, datetime_style, None, None
+                value = authors.format_emails(value, 'ticket', tkt_id)
+                return value, style, None, None
+        elif name == 'milestone':
+            get_metrics = book.get_metrics
+            def convert(value, tkt_id):
+                if isinstance(value, datetime):
+                    return value, datetime_style, None, None
+                if not value:
+                    return '', style, None, None
+                width, line = get_metrics(value)
+                return value, style, width, line
+        else:
+            def convert(value, tkt_id):
+                if isinstance(value, datetime):
+                    return value, datetime_style, None, None
+                return value, style, None, None
+        return convert
 
-        return value, name, None, None
+
+class _ReportSQLError(Exception):
+    """The SQL of a report failed while exporting it."""
 
 
 class ExcelReportModule(Component):
@@ -476,11 +859,46 @@ class ExcelReportModule(Component):
 
     _PATH_INFO_MATCH = re.compile(r'/report/[0-9]+').match
 
+    # the tables following FROM or JOIN, with their aliases, e.g.
+    # "FROM ticket t, enum p" or "JOIN milestone AS m"
+    _TABLES_RE = re.compile(r'\b(?:FROM|JOIN)\s+([\w"]+)'
+                            r'((?:\s+(?:AS\s+)?\w+)?'
+                            r'(?:\s*,\s*[\w"]+(?:\s+(?:AS\s+)?\w+)?)*)',
+                            re.IGNORECASE)
+    _MORE_TABLES_RE = re.compile(r',\s*([\w"]+)')
+
+    # queries returning rows which change with the contents of the tables
+    # a cached report may select from
+    _TABLE_TOKENS = {
+        'ticket': "SELECT MAX(changetime),COUNT(*) FROM ticket",
+        # custom fields are changed with the change time of the ticket
+        'ticket_custom': "SELECT MAX(changetime),COUNT(*) FROM ticket",
+        'ticket_change': "SELECT MAX(time),COUNT(*) FROM ticket_change",
+        'enum': "SELECT type,name,value FROM enum ORDER BY type,name",
+        'component': "SELECT name,owner,description FROM component "
+                     "ORDER BY name",
+        'milestone': "SELECT name,due,completed,description FROM milestone "
+                     "ORDER BY name",
+        'version': "SELECT name,time,description FROM version ORDER BY name",
+    }
+
     def pre_process_request(self, req, handler):
         if self._PATH_INFO_MATCH(req.path_info) \
                 and req.args.get('format') in ('xlsx', 'xls') \
                 and handler.__class__.__name__ == 'ReportModule':
             req.args['max'] = 0
+            format = req.args.get('format')
+            cache_key = self._get_cache_key(req)
+            if cache_key:
+                content = ExcelDownloadCache(self.env).fetch(cache_key)
+                if content:
+                    req.perm.require('REPORT_VIEW',
+                                     Resource('report', req.args['id']))
+                    mimetype = get_excel_mimetype(get_excel_format(self.env))
+                    self._send_content(req, format, mimetype, content)
+            report = self._get_report_sql(req)
+            if report:
+                self._stream_report(req, format, report, cache_key)
         return handler
 
     def post_process_request(self, req, template, data, content_type):
@@ -490,142 +908,417 @@ class ExcelReportModule(Component):
                 resource = Resource('report', req.args['id'])
                 data['context'] = Context.from_request(req, resource,
                                                        absurls=True)
-                self._convert_report(format, req, data)
+                cache_key = self._get_cache_key(req)
+                jobs = ExcelExportJobModule(self.env)
+                if jobs.is_requested(req):
+                    filename = 'report_%s.%s' % (req.args['id'], format)
+                    jobs.enqueue(req, filename,
+                                 lambda req: self._create_report(
+                                     req, data, cache_key)[1:])
+                self._convert_report(format, req, data, cache_key)
             elif not format:
                 self._add_alternate_links(req)
         return template, data, content_type
 
-    def _convert_report(self, format, req, data):
+    def _convert_report(self, format, req, data, cache_key):
+        size, content, mimetype = self._create_report(req, data, cache_key)
+        self._send_content(req, format, mimetype, (size, content))
+
+    def _create_report(self, req, data, cache_key):
+        timings = ExportTimings(self.env, 'report %s' % req.args.get('id'))
+        canceller = ExportCanceller(self.env, req)
+        row_groups = ((value_for_group, len(row_group),
+                       ([[cell['value'] for cell in cell_group]
+                         for cell_group in row['cell_groups']]
+                        for row in row_group))
+                      for value_for_group, row_group in data['row_groups'])
+        return self._write_report(req, data['title'], data['numrows'],
+                                  data['header_groups'], row_groups, timings,
+                                  canceller, cache_key)
+
+    def _get_report_sql(self, req):
+        """Return a tuple of the id, the title, the SQL and the arguments of
+        the requested report for exporting it straight from the rows of the
+        cursor, or `None` when the report must be rendered by
+        `ReportModule`.
+        """
+        if req.args.get('sort'):
+            return None  # sorted by ReportModule after fetching all rows
+        id = int(req.args['id'])
+        cursor = _get_db(self.env).cursor()
+        cursor.execute("SELECT title,query FROM report WHERE id=%s", (id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        title, sql = row
+        query = ''.join(line.strip() for line in (sql or '').splitlines())
+        if not query or query.startswith(('?', 'query:')):
+            return None  # redirected to the query module
+
+        req.perm.require('REPORT_VIEW', Resource('report', id))
+        report_mod = ReportModule(self.env)
+        try:
+            args = report_mod.get_var_args(req)
+        except ValueError:
+            return None
+        title = sub_vars('{%i} %s' % (id, title), args)
+        if 'db' in inspect.getargspec(report_mod.sql_sub_vars)[0]:
+            sql, args, missing_args = report_mod.sql_sub_vars(
+                sql, args, _get_db(self.env))
+        else:
+            sql, args, missing_args = report_mod.sql_sub_vars(sql, args)
+        sql = sql.replace(SORT_COLUMN, '1').replace(LIMIT_OFFSET, '')
+        return id, title, sql, args
+
+    def _stream_report(self, req, format, report, cache_key):
+        jobs = ExcelExportJobModule(self.env)
+        if jobs.is_requested(req):
+            filename = 'report_%s.%s' % (report[0], format)
+            jobs.enqueue(req, filename,
+                         lambda req: self._create_report_sql(
+                             req, report, cache_key)[1:])
+        try:
+            size, content, mimetype = self._create_report_sql(req, report,
+                                                              cache_key)
+        except _ReportSQLError:
+            return  # let ReportModule report the failure
+        self._send_content(req, format, mimetype, (size, content))
+
+    def _create_report_sql(self, req, report, cache_key):
+        id, title, sql, args = report
+        timings = ExportTimings(self.env, 'report %s' % id)
+        canceller = ExportCanceller(self.env, req)
+        db = _get_db(self.env)
+        cursor = db.cursor()
+        try:
+            with timings.phase('query'):
+                cursor.execute(sql, args)
+        except Exception, e:
+            self.log.warn("Exception caught while executing Report {%d}: "
+                          "%s", id, exception_to_unicode(e))
+            raise _ReportSQLError(e)
+        cols = [to_unicode(d[0]) for d in cursor.description]
+        header_groups = self._get_header_groups(cols)
+
+        context = Context.from_request(req, Resource('report', id),
+                                       absurls=True)
+        authors = _AuthorFormatter(self.env, req, context)
+        rows = self._iter_report_rows(req, authors, cols, header_groups,
+                                      self._fetch_report_rows(id, cursor))
+
+        # The headers show the numbers of the viewable rows of the report
+        # and of each run of a `__group__` value like `ReportModule`, so
+        # the rows are spooled to a temporary file until they are counted.
+        spool = SpooledTemporaryFile(
+            max_size=ExcelDownloadConfig(self.env).spool_size)
+        try:
+            groups = []
+            with timings.phase('fetch'):
+                pickler = cPickle.Pickler(spool, cPickle.HIGHEST_PROTOCOL)
+                pickler.fast = True  # no memo which would keep the rows
+                dump = pickler.dump
+                for value, group in groupby(rows, lambda row: row[0]):
+                    num = 0
+                    for value, cell_groups in group:
+                        dump(cell_groups)
+                        num += 1
+                    groups.append((value, num))
+            spool.seek(0)
+            load = cPickle.Unpickler(spool).load
+            numrows = sum(num for value, num in groups)
+            row_groups = ((value and authors.format_author(value), num,
+                           (load() for idx in xrange(num)))
+                          for value, num in groups)
+            return self._write_report(req, title, numrows, header_groups,
+                                      row_groups, timings, canceller,
+                                      cache_key)
+        finally:
+            spool.close()
+
+    def _fetch_report_rows(self, id, cursor):
+        try:
+            for row in cursor:
+                yield row
+        except Exception, e:
+            self.log.warn("Exception caught while fetching Report {%d}: "
+                          "%s", id, exception_to_unicode(e))
+            raise _ReportSQLError(e)
+
+    def _get_header_groups(self, cols):
+        """Place the columns in groups like `ReportModule`: `_col_` is a
+        full row, `col_` ends the current group, `__col__` and `_col` are
+        hidden.
+        """
+        field_labels = TicketSystem(self.env).get_ticket_field_labels()
+        header_groups = [[]]
+        for col in cols:
+            if col in field_labels:
+                title = field_labels[col]
+            else:
+                title = col.strip('_').capitalize()
+            header = {'col': col, 'title': title, 'hidden': False}
+            header_group = header_groups[-1]
+            if col.startswith('__') and col.endswith('__'):
+                header['hidden'] = True
+            elif col[0] == '_' and col[-1] == '_':
+                header_group = []
+                header_groups.append(header_group)
+                header_groups.append([])
+            elif col[0] == '_':
+                header['hidden'] = True
+            elif col[-1] == '_':
+                header_groups.append([])
+            header_group.append(header)
+        return header_groups
+
+    def _iter_report_rows(self, req, authors, cols, header_groups, cursor):
+        """Yield a tuple of the `__group__` value and the values of the
+        cell groups for each row of `cursor` which the user may view.
+        """
+        def index(match):
+            # the last matching column wins like in ReportModule
+            idxs = [idx for idx, col in enumerate(cols) if match(col)]
+            return idxs[-1] if idxs else None
+
+        group_idx = index(lambda col: col == '__group__')
+        id_idx = index(lambda col: col in ('report', 'ticket', 'id', '_id'))
+        realm_idx = index(lambda col: col.strip('_') == 'realm')
+        parent_realm_idx = index(lambda col: col.strip('_') == 'parent_realm')
+        parent_id_idx = index(lambda col: col.strip('_') == 'parent_id')
+        email_idxs = [idx for idx, col in enumerate(cols)
+                          if col.strip('_') in ('reporter', 'cc', 'owner')]
+        cell_idxs = []
+        start = 0
+        for header_group in header_groups:
+            cell_idxs.append(range(start, start + len(header_group)))
+            start += len(header_group)
+
+        fine_grained = has_fine_grained_policies(self.env)
+        realms = {}  # realm -> permission granted, without fine grained
+        for result in cursor:
+            values = [cell_value(value) for value in result]
+            realm = 'ticket' if realm_idx is None else values[realm_idx]
+            tkt_id = None if id_idx is None else values[id_idx]
+            if parent_realm_idx is not None and values[parent_realm_idx]:
+                resource = Resource(realm, tkt_id, parent=Resource(
+                    values[parent_realm_idx],
+                    '' if parent_id_idx is None else values[parent_id_idx]))
+            else:
+                resource = Resource(realm, tkt_id)
+            action = realm.upper() + '_VIEW'
+            if fine_grained:
+                if action not in req.perm(resource):
+                    continue
+            else:
+                if realm not in realms:
+                    realms[realm] = action in req.perm(resource)
+                if not realms[realm]:
+                    continue
+            for idx in email_idxs:
+                values[idx] = authors.format_emails(values[idx], realm,
+                                                    resource.id,
+                                                    resource.parent)
+            yield None if group_idx is None else values[group_idx], \
+                  [[values[idx] for idx in idxs] for idxs in cell_idxs]
+
+    def _write_report(self, req, title, numrows, header_groups, row_groups,
+                      timings, canceller, cache_key):
+        """Write the report and return a tuple of the size, the content and
+        the mimetype of the Excel file. `row_groups` yields a tuple of the
+        `__group__` value, the number of rows and the rows of each group,
+        where each row is a list of the cell values of each header group.
+        The file is stored in the cache for `cache_key` unless it's `None`.
+        """
         book = get_workbook_writer(self.env, req)
         writer = book.create_sheet(dgettext('messages', 'Report'))
+        plan = self._get_column_plan(header_groups, book)
 
         writer.write_row([(
-            '%s (%s)' % (data['title'],
-                         dngettext('messages', '%(num)s match',
-                                   '%(num)s matches', data['numrows'])),
+            '%s (%s)' % (title, dngettext('messages', '%(num)s match',
+                                          '%(num)s matches', numrows)),
             'header', -1, -1)])
 
-        for value_for_group, row_group in data['row_groups']:
+        started = timings.start()
+        nrows = ncells = 0
+        for value_for_group, num, rows in row_groups:
             writer.move_row()
 
-            if value_for_group and len(row_group):
+            if value_for_group and num:
                 writer.write_row([(
                     '%s (%s)' % (value_for_group,
                                  dngettext('messages', '%(num)s match',
-                                           '%(num)s matches', len(row_group))),
+                                           '%(num)s matches', num)),
                     'header2', -1, -1)])
-            for header_group in data['header_groups']:
+            for header_group in header_groups:
                 writer.write_row([
                     (header['title'], 'thead', None, None)
                     for header in header_group
                     if not header['hidden']])
 
-            for row in row_group:
-                for cell_group in row['cell_groups']:
-                    cells = []
-                    for cell in cell_group:
-                        cell_header = cell['header']
-                        if cell_header['hidden']:
-                            continue
-                        col = cell_header['col'].strip('_').lower()
-                        value, style, width, line = \
-                            self._get_cell_data(req, col, cell, row, writer)
-                        cells.append((value, style, width, line))
+            for row in rows:
+                for values, group_plan in zip(row, plan):
+                    cells = [convert(value)
+                             for value, convert in zip(values, group_plan)
+                             if convert]
                     writer.write_row(cells)
+                    nrows += 1
+                    ncells += len(cells)
+                    canceller.checkpoint()
+        timings.stop('rows', started, nrows, ncells)
+
+        with timings.phase('col_widths'):
+            writer.set_col_widths()
+
+        canceller.check()
+        with timings.phase('dump'):
+            if cache_key:
+                size, content = ExcelDownloadCache(self.env).store(cache_key,
+                                                                   book)
+            else:
+                size, content = book.iterdump()
+        timings.report(req)
+        return size, content, book.mimetype
 
-        writer.set_col_widths()
-
-        content = book.dumps()
+    def _send_content(self, req, format, mimetype, content):
+        size, content = encode_content(self.env, req, mimetype, content)
         req.send_response(200)
-        req.send_header('Content-Type', book.mimetype)
-        req.send_header('Content-Length', len(content))
+        req.send_header('Content-Type', mimetype)
+        if size is not None:
+            req.send_header('Content-Length', size)
         req.send_header('Content-Disposition',
                         'filename=report_%s.%s' % (req.args['id'], format))
         req.end_headers()
-        req.write(content)
+        for chunk in content:
+            req.write(chunk)
         raise RequestDone
 
-    def _get_cell_data(self, req, col, cell, row, writer):
-        value = cell['value']
-        
-        if col == 'tt_spent':
-            if not value:
-                value = 0
-                return value, col, None, None
-            width = len(value)
-            value = float(re.findall('[\d\.]+', cell['value'])[0])
-            return value, col, width, None
-
-        if col == 'tt_estimated':
-            if not value:
-                value = 0
-                return value, col, None, None
-            width = len(value)
-            value = float(re.findall('[\d\.]+', cell['value'])[0])
-            return value, col, width, None
-
-        if col == 'tt_remaining':
-            if not value:
-                value = 0
-                return value, col, None, None
-            width = len(value)
-            value = float(re.findall('[\d\.]+', cell['value'])[0])
-            return value, col, width, None
+    def _get_cache_key(self, req):
+        """Return the cache key of the requested report, computed once for
+        each request, or `None` if the report isn't cached.
+        """
+        try:
+            return req.environ['tracexceldownload.report_cache_key']
+        except KeyError:
+            key = self._create_cache_key(req)
+            req.environ['tracexceldownload.report_cache_key'] = key
+            return key
+
+    def _create_cache_key(self, req):
+        cache = ExcelDownloadCache(self.env)
+        if not cache.enabled:
+            return None
+        try:
+            id = int(req.args.get('id'))
+        except (TypeError, ValueError):
+            return None
+        cursor = _get_db(self.env).cursor()
+        cursor.execute("SELECT query FROM report WHERE id=%s", (id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        sql = row[0]
+        tokens = self._get_table_tokens(cursor, sql)
+        if tokens is None:
+            return None
+        args = sorted((name, req.args.get(name)) for name in req.args
+                      if name.isupper() or name in ('sort', 'asc'))
+        return cache.get_key(
+            'report', id, sql, args,
+            req.authname if '$USER' in sql else None,
+            req.args.get('format'), ExcelDownloadConfig(self.env).format,
+            get_permission_fingerprint(self.env, req), req.tz,
+            getattr(req, 'locale', None), tokens)
+
+    def _get_table_tokens(self, cursor, sql):
+        """Return the rows which change with the contents of the tables
+        which `sql` selects from, or `None` if a table isn't tracked.
+        """
+        tables = set()
+        for match in self._TABLES_RE.finditer(sql or ''):
+            tables.add(match.group(1))
+            tables.update(self._MORE_TABLES_RE.findall(match.group(2)))
+        queries = set()
+        for table in tables:
+            query = self._TABLE_TOKENS.get(table.strip('"').lower())
+            if not query:
+                return None
+            queries.add(query)
+        tokens = []
+        for query in sorted(queries):
+            cursor.execute(query)
+            tokens.append(cursor.fetchall())
+        return tokens
+
+    def _get_column_plan(self, header_groups, book):
+        """Return the converters of the cells for `header_groups`, `None`
+        for the hidden columns. Each converter takes the value of a cell and
+        returns a cell tuple for `write_row()` with the style resolved by
+        `book`.
+        """
+        return [[None if header['hidden'] else
+                 self._get_cell_converter(header['col'].strip('_').lower(),
+                                          book)
+                 for header in header_group]
+                for header_group in header_groups]
+
+    def _get_cell_converter(self, col, book):
+        style = book.resolve_style(col)
+        get_metrics = book.get_metrics
+
+        if col in ('tt_spent', 'tt_estimated', 'tt_remaining'):
+            def convert(value):
+                if not value:
+                    return 0, style, None, None
+                width = len(value)
+                value = float(re.findall('[\d\.]+', value)[0])
+                return value, style, width, None
+            return convert
 
         if col == 'br_planned':
-            if not value:
-                value = 0
-                return value, col, None, None
-            width = len(value)
-            try:
-                value = float(value)
-            except ValueError:
-                pass  # leave value as is
-            return value, col, width, None
+            def convert(value):
+                if not value:
+                    return 0, style, None, None
+                width = len(value)
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass  # leave value as is
+                return value, style, width, None
+            return convert
 
         if col == 'parent':
-            if not value:
-                value = ''
-                return value, col, None, None
-            value = int(float(re.findall('[\d]+', value)[0]))
-            url = self.env.abs_href.ticket(value)
-            value = '#%d' % value
-            width = len(value)
-            value = Formula('HYPERLINK("%s",%s)' % (url, get_literal(value)))
-            return value, col, width, 1
-
-        if col == 'report':
-            url = self.env.abs_href.report(value)
-            width, line = writer.get_metrics(value)
-            return value, col, width, line
+            abs_href = self.env.abs_href
+            def convert(value):
+                if not value:
+                    return '', style, None, None
+                value = int(float(re.findall('[\d]+', value)[0]))
+                url = abs_href.ticket(value)
+                value = '#%d' % value
+                return Hyperlink(url, value), style, len(value), 1
+            return convert
 
         if col in ('ticket', 'id'):
-            id_value = cell['value']
-            value = '#%s' % id_value
-            url = get_resource_url(self.env, row['resource'], self.env.abs_href)
-            width = len(value)
-            return id_value, 'id', width, 1
-
-        if col == 'milestone':
-            url = self.env.abs_href.milestone(value)
-            width, line = writer.get_metrics(value)
-            return value, col, width, line
-
-        if col == 'time':
-            if isinstance(value, basestring) and value.isdigit():
-                value = from_utimestamp(long(value))
-                return value, '[time]', None, None
-        elif col in ('date', 'created', 'modified'):
-            if isinstance(value, basestring) and value.isdigit():
-                value = from_utimestamp(long(value))
-                return value, '[date]', None, None
-        elif col == 'datetime':
-            if isinstance(value, basestring) and value.isdigit():
-                value = from_utimestamp(long(value))
-                return value, '[datetime]', None, None
-
-        width, line = writer.get_metrics(value)
-        return value, col, width, line
+            id_style = book.resolve_style('id')
+            def convert(value):
+                return value, id_style, len('#%s' % value), 1
+            return convert
+
+        def convert(value):
+            width, line = get_metrics(value)
+            return value, style, width, line
+
+        name = {'time': '[time]', 'date': '[date]', 'created': '[date]',
+                'modified': '[date]', 'datetime': '[datetime]'}.get(col)
+        if name:
+            default = convert
+            time_style = book.resolve_style(name)
+            time_width = _get_datetime_width(name)
+            def convert(value):
+                if isinstance(value, basestring) and value.isdigit():
+                    return from_utimestamp(long(value)), time_style, \
+                           time_width, None
+                return default(value)
+        return convert
 
     def _add_alternate_links(self, req):
         params = {}
@@ -14,7 +14,7 @@ except ImportError:
 
 if domain_functions:
     from trac.util.translation import dgettext, dngettext
-    from trac.config import ChoiceOption
+    from trac.config import BoolOption, ChoiceOption, FloatOption, IntOption
 
     def domain_options(domain, *options):
         import inspect
@@ -43,7 +43,8 @@ if domain_functions:
 
     _, N_, gettext, ngettext, add_domain = domain_functions(
         'tracexceldownload', '_', 'N_', 'gettext', 'ngettext', 'add_domain')
-    ChoiceOption = domain_options('tracexceldownload', ChoiceOption)
+    BoolOption, ChoiceOption, FloatOption, IntOption = domain_options(
+        'tracexceldownload', BoolOption, ChoiceOption, FloatOption, IntOption)
 
 
     class TranslationModule(Component):
@@ -66,6 +67,7 @@ if domain_functions:
 
 else:
     from trac.util.translation import _, N_, gettext, ngettext
+    from trac.config import BoolOption, FloatOption, IntOption
 
     class ChoiceOption(Option):
         def __init__(self, section, name, choices, doc=''):